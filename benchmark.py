@@ -0,0 +1,338 @@
+"""Benchmark of the geoffrey_bot download pipeline with a simulated Telegram.
+
+Runs the real handler -> download_queue -> download_worker path against fake
+clients and messages whose downloads stream synthetic bytes with a
+configurable bandwidth, latency and failure rate, so performance can be
+measured without a Telegram account.
+
+Usage:
+    python benchmark.py --workers 1,2,4 --sizes 5,100 --files 6
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import contextlib
+import statistics
+from types import SimpleNamespace
+
+BENCH_DIR = tempfile.mkdtemp(prefix='geoffrey_bench_')
+
+# geoffrey_bot reads its configuration on import
+os.environ.setdefault('API_ID', '1')
+os.environ.setdefault('API_HASH', 'benchmark')
+os.environ.setdefault('ALLOWED_USERS', '1')
+os.environ['DOWNLOAD_PATH'] = os.path.join(BENCH_DIR, 'downloads')
+os.environ.setdefault('PROGRESS_INTERVAL', '0.5')
+os.chdir(BENCH_DIR)  # The Telegram session file is created in the working directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import geoffrey_bot  # noqa: E402
+from telethon.tl.types import (  # noqa: E402
+    Document, DocumentAttributeFilename, MessageMediaDocument)
+
+MB = 1024 * 1024
+SYNTHETIC_BLOCK = os.urandom(geoffrey_bot.DOWNLOAD_REQUEST_SIZE)
+
+
+class FakeLink:
+    """Shared link capacity, every connection draws from the same budget."""
+
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth  # bytes per second, 0 for unlimited
+        self.available_at = time.monotonic()
+
+    async def transfer(self, size):
+        if not self.bandwidth:
+            return
+        now = time.monotonic()
+        self.available_at = max(self.available_at, now) + size / self.bandwidth
+        await asyncio.sleep(self.available_at - now)
+
+
+class FakeClient:
+    """Stands in for TelegramClient, streaming synthetic document bytes."""
+
+    def __init__(self, bandwidth, latency, failure_rate, link):
+        self.bandwidth = bandwidth  # bytes per second per connection
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.link = link
+        self.requests = 0
+
+    async def fetch(self, size):
+        self.requests += 1
+        if random.random() < self.failure_rate:
+            await asyncio.sleep(self.latency)
+            raise ConnectionError('Simulated connection drop')
+        await asyncio.sleep(self.latency + size / self.bandwidth)
+        await self.link.transfer(size)
+        return memoryview(SYNTHETIC_BLOCK)[:size]
+
+    def iter_download(self, document, *, offset=0, limit=None, request_size=None,
+                      file_size=None, **kwargs):
+        request_size = request_size or geoffrey_bot.DOWNLOAD_REQUEST_SIZE
+        size = file_size or document.size
+
+        async def stream():
+            position = offset
+            count = 0
+            while position < size and (limit is None or count < limit):
+                chunk_size = min(request_size, size - position)
+                yield await self.fetch(chunk_size)
+                position += chunk_size
+                count += 1
+        return stream()
+
+    async def download_media(self, message, file, progress_callback=None):
+        # Same contract as Telethon: the callback gets (received, total)
+        # after every chunk and is awaited when it is a coroutine
+        total = message.media.document.size
+        received = 0
+        with open(file, 'wb') as f:
+            async for chunk in self.iter_download(message.media.document):
+                f.write(chunk)
+                received += len(chunk)
+                if progress_callback:
+                    result = progress_callback(received, total)
+                    if asyncio.iscoroutine(result):
+                        await result
+        return file
+
+
+class FakeSentMessage:
+    """Message sent by the bot, counting the API calls made on it."""
+
+    def __init__(self, stats, text):
+        self.stats = stats
+        self.text = text
+
+    async def edit(self, text, **kwargs):
+        self.stats['edits'] += 1
+        self.text = text
+
+    async def delete(self):
+        self.stats['deletes'] += 1
+
+    async def reply(self, text, **kwargs):
+        self.stats['replies'] += 1
+        return FakeSentMessage(self.stats, text)
+
+
+class FakeMessage:
+    _next_id = 1
+
+    def __init__(self, client, stats, filename, size, mime_type, text='', sender_id=1):
+        self.id = FakeMessage._next_id
+        FakeMessage._next_id += 1
+        self.chat_id = sender_id
+        self.sender_id = sender_id
+        self.grouped_id = None
+        self.text = text
+        self.client = client
+        self.stats = stats
+        self.media = MessageMediaDocument(document=Document(
+            id=self.id, access_hash=self.id, file_reference=b'', date=None,
+            mime_type=mime_type, size=size, dc_id=2,
+            attributes=[DocumentAttributeFilename(filename)]))
+        self.file = SimpleNamespace(size=size, name=filename)
+
+    async def reply(self, text, **kwargs):
+        self.stats['replies'] += 1
+        return FakeSentMessage(self.stats, text)
+
+    async def download_media(self, file=None, progress_callback=None):
+        return await self.client.download_media(self, file, progress_callback)
+
+
+class FakeEvent:
+    def __init__(self, message, sender_id=1):
+        self.message = message
+        self.sender_id = sender_id
+
+    async def reply(self, text, **kwargs):
+        return await self.message.reply(text, **kwargs)
+
+
+def reset_pipeline(scenario_dir):
+    """Fresh queues, journal, index and metrics for one scenario."""
+    geoffrey_bot.DOWNLOAD_PATH = scenario_dir
+    # Closed here, otherwise the GC closes them later in the middle of a measurement
+    for store in (geoffrey_bot.download_journal, geoffrey_bot.library_index,
+                  geoffrey_bot.search_index, geoffrey_bot.checksum_manifest):
+        if store is not None:
+            store.close()
+    geoffrey_bot.download_queue = geoffrey_bot.DownloadScheduler()
+    geoffrey_bot.active_downloads.clear()
+    geoffrey_bot.download_journal = geoffrey_bot.DownloadJournal(
+        os.path.join(scenario_dir, '.queue.db'))
+    geoffrey_bot.library_index = geoffrey_bot.LibraryIndex(
+        os.path.join(scenario_dir, '.library.db'))
+    geoffrey_bot.search_index = geoffrey_bot.SearchIndex(
+        os.path.join(scenario_dir, '.search.db'))
+    geoffrey_bot.checksum_manifest = geoffrey_bot.ChecksumManifest(
+        os.path.join(scenario_dir, '.checksums.db'))
+    geoffrey_bot.library_catalog = geoffrey_bot.LibraryCatalog(scenario_dir)
+    geoffrey_bot.disk_space = geoffrey_bot.DiskSpace(scenario_dir)
+    geoffrey_bot.metrics = geoffrey_bot.PipelineMetrics()
+    # The benchmark sends commands far faster than a person would
+    geoffrey_bot.command_throttle = geoffrey_bot.CommandThrottle(rate=0)
+
+
+async def run_download_scenario(args, workers, size_mb):
+    scenario_dir = os.path.join(BENCH_DIR, f'run_{workers}w_{size_mb}mb')
+    os.makedirs(scenario_dir)
+    reset_pipeline(scenario_dir)
+
+    link = FakeLink(args.link * MB)
+    client = FakeClient(args.bandwidth * MB, args.latency, args.failure_rate, link)
+    stats = {'replies': 0, 'edits': 0, 'deletes': 0}
+
+    worker_tasks = [asyncio.create_task(
+        geoffrey_bot.download_worker(geoffrey_bot.download_queue, i)) for i in range(workers)]
+    started = time.monotonic()
+
+    for i in range(args.files):
+        message = FakeMessage(client, stats, f'file_{size_mb}mb_{i}.pdf',
+                              int(size_mb * MB), 'application/pdf')
+        await geoffrey_bot.handler(FakeEvent(message))
+
+    await geoffrey_bot.download_queue.join()
+    elapsed = time.monotonic() - started
+
+    for task in worker_tasks:
+        task.cancel()
+    await asyncio.gather(*worker_tasks, return_exceptions=True)
+
+    queue_wait = geoffrey_bot.metrics.queue_wait
+    first_byte = geoffrey_bot.metrics.time_to_first_byte
+    total_bytes = args.files * int(size_mb * MB)
+    return {
+        'workers': workers,
+        'size_mb': size_mb,
+        'elapsed': elapsed,
+        'throughput': total_bytes / MB / elapsed,
+        'queue_wait': queue_wait.total / max(queue_wait.count, 1),
+        'first_byte': first_byte.total / max(first_byte.count, 1),
+        'completed': geoffrey_bot.metrics.downloads['completed'],
+        'requests': client.requests,
+        'edits': stats['edits'],
+    }
+
+
+def measure_progress_callback(calls=200_000):
+    """Cost of one progress callback as seen by the download hot path."""
+    entry = geoffrey_bot.ProgressEntry(None, '', calls)
+    callback = geoffrey_bot.time_first_byte(entry.update, time.monotonic())
+    started = time.perf_counter()
+    for i in range(calls):
+        callback(i, calls)
+    return (time.perf_counter() - started) / calls * 1e9
+
+
+async def measure_list_latency(files, repeats=20):
+    """Latency of /listar over a library with `files` videos."""
+    library_dir = os.path.join(BENCH_DIR, 'library')
+    video_dir = os.path.join(library_dir, 'Video')
+    os.makedirs(video_dir, exist_ok=True)
+    for i in range(files):
+        with open(os.path.join(video_dir, f'video_{i:05d}.mkv'), 'wb'):
+            pass
+
+    reset_pipeline(library_dir)
+    started = time.perf_counter()
+    geoffrey_bot.library_catalog.build()
+    build_time = time.perf_counter() - started
+
+    stats = {'replies': 0, 'edits': 0, 'deletes': 0}
+    client = FakeClient(MB, 0, 0, FakeLink(0))
+    timings = []
+    for _ in range(repeats):
+        event = FakeEvent(FakeMessage(client, stats, 'x', 0, 'text/plain', text='/listar video'))
+        started = time.perf_counter()
+        await geoffrey_bot.handler(event)
+        timings.append(time.perf_counter() - started)
+    replies = stats['replies'] / repeats
+
+    started = time.perf_counter()
+    geoffrey_bot.search_index.sync(geoffrey_bot.library_catalog)
+    index_time = time.perf_counter() - started
+
+    search_timings = []
+    for i in range(repeats):
+        event = FakeEvent(FakeMessage(client, stats, 'x', 0, 'text/plain', text=f'/buscar video {i}'))
+        started = time.perf_counter()
+        await geoffrey_bot.handler(event)
+        search_timings.append(time.perf_counter() - started)
+
+    return (build_time, statistics.median(timings), replies,
+            index_time, statistics.median(search_timings))
+
+
+async def main(args):
+    random.seed(args.seed)
+    print(f"Benchmark directory: {BENCH_DIR}")
+    print(f"Simulated link: {args.bandwidth} MB/s per connection, "
+          f"{args.link or 'unlimited'} MB/s total, {args.latency * 1000:.0f}ms latency, "
+          f"{args.failure_rate:.1%} failures\n")
+
+    reporter = asyncio.create_task(geoffrey_bot.progress_reporter.run())
+    # Like the bot's startup, so loading guessit doesn't skew the first scenario
+    await geoffrey_bot.metadata_service.prewarm()
+
+    header = (f"{'workers':>7} {'size':>8} {'files':>5} {'time':>8} {'MB/s':>8} "
+              f"{'queue wait':>10} {'1st byte':>9} {'requests':>8} {'edits':>6}")
+    print(header)
+    print('-' * len(header))
+    # The bot prints every step, keep the table readable unless asked for it
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+    for size_mb in args.sizes:
+        for workers in args.workers:
+            with quiet:
+                result = await run_download_scenario(args, workers, size_mb)
+            print(f"{result['workers']:>7} {result['size_mb']:>6}MB {result['completed']:>5} "
+                  f"{result['elapsed']:>7.2f}s {result['throughput']:>8.1f} "
+                  f"{result['queue_wait']:>9.2f}s {result['first_byte'] * 1000:>7.0f}ms "
+                  f"{result['requests']:>8} {result['edits']:>6}")
+
+    reporter.cancel()
+
+    print(f"\nProgress callback: {measure_progress_callback():.0f} ns/call")
+
+    with quiet:
+        build_time, list_time, replies, index_time, search_time = await measure_list_latency(
+            args.library_files)
+    print(f"/listar with {args.library_files} files: catalog built in {build_time * 1000:.1f}ms, "
+          f"{list_time * 1000:.2f}ms per request, {replies:.0f} message(s) per request")
+    print(f"/buscar with {args.library_files} files: indexed in {index_time:.2f}s, "
+          f"{search_time * 1000:.2f}ms per request")
+
+
+def parse_list(value, cast):
+    return [cast(item) for item in value.split(',') if item]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=lambda v: parse_list(v, int), default=[1, 2, 4],
+                        help='Comma-separated worker counts to compare')
+    parser.add_argument('--sizes', type=lambda v: parse_list(v, float), default=[5, 100],
+                        help='Comma-separated file sizes in MB')
+    parser.add_argument('--files', type=int, default=6, help='Files sent per scenario')
+    parser.add_argument('--bandwidth', type=float, default=20,
+                        help='Simulated MB/s of each connection')
+    parser.add_argument('--link', type=float, default=0,
+                        help='Simulated MB/s of the whole link, 0 for unlimited')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Simulated seconds of latency per request')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Probability of a request failing')
+    parser.add_argument('--library-files', type=int, default=5000,
+                        help='Files in the library used for the /listar benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the bot')
+    asyncio.run(main(parser.parse_args()))
@@ -1,7 +1,13 @@
 import os
 import sys
 import re
+import json
+import time
+import sqlite3
+import asyncio
+from collections import deque
 from telethon import TelegramClient, events, sync
+from telethon.tl.types import Channel, Chat, InputPeerChannel, InputPeerChat, InputPeerUser
 import textwrap
 
 from dataclasses import dataclass
@@ -11,6 +17,172 @@ if os.getenv('DEVELOPMENT'):
     load_dotenv()
 
 
+class MessageCache:
+    """Local SQLite copy of channel message metadata and known entities.
+
+    Messages are stored as (id, date, text, file name, size, mime) with an
+    FTS5 index over text and file name. Each channel is synced
+    incrementally from the highest id already cached, so searches and
+    listings run locally and only reach Telegram when a sync is due. Edits
+    and deletions after a message was cached are not picked up. Entities
+    seen while reading dialogs are kept too, so a channel can be resolved
+    without listing every dialog again.
+    """
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db = sqlite3.connect(db_path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            ' chat_id INTEGER NOT NULL,'
+            ' id INTEGER NOT NULL,'
+            ' date REAL,'
+            ' text TEXT,'
+            ' file_name TEXT,'
+            ' size INTEGER,'
+            ' mime TEXT,'
+            ' PRIMARY KEY (chat_id, id))'
+        )
+        self.db.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5('
+            " text, file_name, tokenize='unicode61 remove_diacritics 2')"
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS sync_state ('
+            ' chat_id INTEGER PRIMARY KEY,'
+            ' max_id INTEGER NOT NULL,'
+            ' synced_at REAL NOT NULL)'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS entities ('
+            ' id INTEGER PRIMARY KEY,'  # Marked id, as in dialog.id
+            ' peer_id INTEGER NOT NULL,'
+            ' access_hash INTEGER,'
+            ' kind TEXT NOT NULL,'
+            ' title TEXT,'
+            ' username TEXT,'
+            ' updated_at REAL NOT NULL)'
+        )
+
+    def max_id(self, chat_id):
+        row = self.db.execute('SELECT max_id FROM sync_state WHERE chat_id = ?', (chat_id,)).fetchone()
+        return row[0] if row else 0
+
+    def synced_at(self, chat_id):
+        """Time of the last sync of a channel, None if it was never synced."""
+        row = self.db.execute('SELECT synced_at FROM sync_state WHERE chat_id = ?', (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def mark_synced(self, chat_id):
+        """Record a sync that found no new messages."""
+        self.db.execute(
+            'INSERT INTO sync_state (chat_id, max_id, synced_at) VALUES (?, 0, ?)'
+            ' ON CONFLICT (chat_id) DO UPDATE SET synced_at = excluded.synced_at',
+            (chat_id, time.time()))
+
+    def store_messages(self, chat_id, messages):
+        """Insert a batch of messages in one transaction and move the sync mark."""
+        if not messages:
+            return
+        self.db.execute('BEGIN')
+        try:
+            for message in messages:
+                file = message.file
+                values = (
+                    chat_id, message.id,
+                    message.date.timestamp() if message.date else None,
+                    message.text or '',
+                    file.name if file else None,
+                    file.size if file else None,
+                    file.mime_type if file else None,
+                )
+                cursor = self.db.execute(
+                    'INSERT OR IGNORE INTO messages (chat_id, id, date, text, file_name, size, mime)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?)', values)
+                if cursor.rowcount:
+                    self.db.execute(
+                        'INSERT INTO messages_fts (rowid, text, file_name) VALUES (?, ?, ?)',
+                        (cursor.lastrowid, values[3], values[4] or ''))
+            self.db.execute(
+                'INSERT INTO sync_state (chat_id, max_id, synced_at) VALUES (?, ?, ?)'
+                ' ON CONFLICT (chat_id) DO UPDATE SET'
+                ' max_id = max(max_id, excluded.max_id), synced_at = excluded.synced_at',
+                (chat_id, max(message.id for message in messages), time.time()))
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+
+    def search(self, chat_id, text, limit=10):
+        """[(id, date, text, file_name, size, mime)] matching every word of `text`, best first."""
+        words = re.findall(r'\w+', text.lower())
+        if not words:
+            return []
+        expression = ' '.join(f'"{word}"*' for word in words)
+        return self.db.execute(
+            'SELECT messages.id, messages.date, messages.text, messages.file_name,'
+            ' messages.size, messages.mime'
+            ' FROM messages_fts JOIN messages ON messages.rowid = messages_fts.rowid'
+            ' WHERE messages_fts MATCH ? AND messages.chat_id = ?'
+            ' ORDER BY bm25(messages_fts, 1.0, 2.0) LIMIT ?',
+            (expression, chat_id, limit)
+        ).fetchall()
+
+    def list_messages(self, chat_id, limit=50, offset=0, media_only=True):
+        """Cached messages of a channel, newest first."""
+        # Photos and some documents have no file name, but every media has a size
+        media = ' AND size IS NOT NULL' if media_only else ''
+        return self.db.execute(
+            'SELECT id, date, text, file_name, size, mime FROM messages'
+            f' WHERE chat_id = ?{media} ORDER BY id DESC LIMIT ? OFFSET ?',
+            (chat_id, limit, offset)
+        ).fetchall()
+
+    def store_entity(self, marked_id, entity):
+        if isinstance(entity, Channel):
+            kind = 'channel'
+        elif isinstance(entity, Chat):
+            kind = 'chat'
+        else:
+            kind = 'user'
+        self.db.execute(
+            'INSERT OR REPLACE INTO entities (id, peer_id, access_hash, kind, title, username, updated_at)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (marked_id, entity.id, getattr(entity, 'access_hash', None), kind,
+             getattr(entity, 'title', None) or getattr(entity, 'first_name', None),
+             getattr(entity, 'username', None), time.time())
+        )
+
+    def find_entity(self, id=None, title=None, kind=None):
+        """Input peer of a cached entity by marked id or exact title, or None.
+
+        `kind` ("channel", "chat" or "user") limits the match to that kind.
+        """
+        kind_filter = ' AND kind = ?' if kind else ''
+        kind_params = (kind,) if kind else ()
+        if id is not None:
+            row = self.db.execute(
+                f'SELECT peer_id, access_hash, kind FROM entities WHERE id = ?{kind_filter}',
+                (id, *kind_params)).fetchone()
+        elif title is not None:
+            row = self.db.execute(
+                f'SELECT peer_id, access_hash, kind FROM entities WHERE title = ?{kind_filter}'
+                ' ORDER BY updated_at DESC LIMIT 1', (title, *kind_params)).fetchone()
+        else:
+            return None
+        if row is None:
+            return None
+
+        peer_id, access_hash, kind = row
+        if kind == 'channel':
+            return InputPeerChannel(peer_id, access_hash)
+        if kind == 'chat':
+            return InputPeerChat(peer_id)
+        return InputPeerUser(peer_id, access_hash)
+
+
 @dataclass
 class TelegramChannelVideoDownloader:
     session: str
@@ -19,6 +191,9 @@ class TelegramChannelVideoDownloader:
     API_HASH: str = os.getenv('API_HASH', '')
     BOT_TOKEN: str = os.getenv('TELEGRAM_BOT_TOKEN', '')
     ID_CHANNEL: str = os.getenv('', '')
+    cache_path: str = None
+    # Seconds a channel's cache is used for searches before new messages are synced
+    sync_interval: float = float(os.getenv('CHANNEL_SYNC_INTERVAL', '3600'))
 
     def __post_init__(self):
         print(os.getenv('API_ID'))
@@ -29,6 +204,8 @@ class TelegramChannelVideoDownloader:
             self.session, self.API_ID, self.API_HASH)
         self.bot_client = TelegramClient(
             'geoffrey', self.API_ID, self.API_HASH).start(bot_token=self.BOT_TOKEN)
+        self.cache = MessageCache(self.cache_path or os.path.join(
+            self.download_path or '.', '.channel_cache.db'))
 
     def download_progress(self, received_bytes, total):
         bar_length = 20
@@ -86,35 +263,188 @@ class TelegramChannelVideoDownloader:
             # print(message)
             self.download_message_media(message)
 
-    def search_message_by_text(self, chat_id, text):
+    def backfill(self, chat_id, concurrency=4, checkpoint_path=None):
+        """Mirror every media document of a channel, resuming from the last checkpoint."""
         with self.client as client:
-            messages = client.get_messages(chat_id, search=text, limit=10)
+            client.loop.run_until_complete(
+                self.backfill_async(chat_id, concurrency, checkpoint_path))
 
-            for i, message in enumerate(messages):
-                print(f'{i} Found message ID: {message.id} Text: {message.text}')
+    async def backfill_async(self, chat_id, concurrency=4, checkpoint_path=None):
+        """Stream the channel over one connection and download with bounded concurrency.
 
-            if len(messages) > 1 or len(messages) == 0: 
-                raise ValueError(
-                    f'{len(messages)} matches of messages were found.')
-            message = messages.pop()
-            message_id = message.id
-            message_text = textwrap.shorten(
-                message.text, width=30, placeholder="...")
+        Messages are read with `iter_messages(min_id=...)` oldest first. The
+        checkpoint stores the highest id up to which every message is done,
+        so an interrupted run continues after it. Failed ids are kept in the
+        checkpoint and retried on the next run.
+        """
+        checkpoint_path = checkpoint_path or os.path.join(
+            self.download_path, f'.backfill_{chat_id}.json')
+        checkpoint = self.load_checkpoint(checkpoint_path)
+        print(f'Backfilling chat_id: {chat_id} from message {checkpoint["last_id"]} '
+              f'with concurrency {concurrency}')
 
-            print(f'ID Message found: {message_id} with text: {message_text}')
-            return message_id
+        semaphore = asyncio.Semaphore(concurrency)
+        in_order = deque()  # ids streamed and not yet covered by the checkpoint
+        finished = set()
+        failed = set(checkpoint['failed'])
+        running = set()
 
-    def get_dialogs(self, id=None, title=None):
+        def advance():
+            # Move the checkpoint over the contiguous run of finished ids
+            last_id = checkpoint['last_id']
+            while in_order and in_order[0] in finished:
+                message_id = in_order.popleft()
+                finished.discard(message_id)
+                last_id = max(last_id, message_id)
+            if last_id != checkpoint['last_id']:
+                checkpoint['last_id'] = last_id
+                checkpoint['failed'] = sorted(failed)
+                self.save_checkpoint(checkpoint_path, checkpoint)
+
+        async def download(message):
+            try:
+                await self.download_message_media_async(message)
+                failed.discard(message.id)
+            except Exception as e:
+                print(f'Fail Downloading message {message.id} error: {str(e)}')
+                failed.add(message.id)
+            finally:
+                semaphore.release()
+                finished.add(message.id)
+                advance()
+
+        async def schedule(message):
+            await semaphore.acquire()
+            task = asyncio.create_task(download(message))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+        # Retry what failed on the previous run before continuing forward
+        if failed:
+            retry_ids = sorted(failed)
+            retry_messages = await self.client.get_messages(chat_id, ids=retry_ids)
+            for message_id, message in zip(retry_ids, retry_messages):
+                if message is not None and self.is_media_document(message):
+                    in_order.append(message_id)
+                    await schedule(message)
+                else:
+                    failed.discard(message_id)
+
+        async for message in self.client.iter_messages(
+                chat_id, min_id=checkpoint['last_id'], reverse=True):
+            in_order.append(message.id)
+            if self.is_media_document(message):
+                await schedule(message)
+            else:
+                finished.add(message.id)
+                advance()
+
+        if running:
+            await asyncio.gather(*running)
+        checkpoint['failed'] = sorted(failed)
+        self.save_checkpoint(checkpoint_path, checkpoint)
+        print(f'\nBackfill done up to message {checkpoint["last_id"]}, '
+              f'{len(failed)} failed')
+
+    def is_media_document(self, message):
+        return message.media is not None and getattr(message.media, 'document', None) is not None
+
+    async def download_message_media_async(self, message):
+        name = message.file.name or f'{message.id}{message.file.ext or ""}'
+        title = self.define_file_name(name)
+        path = os.path.join(self.download_path, title)
+
+        if os.path.exists(path) and os.path.getsize(path) == message.file.size:
+            print(f'Skipping {title}, already downloaded')
+            return
+
+        print(f'Downloading {title} chat_id {message.id}')
+        # Write to a temporary name so an interrupted file is never taken as done
+        await message.download_media(f'{path}.part')
+        os.replace(f'{path}.part', path)
+        print(f'Downloaded {title}')
+
+    def load_checkpoint(self, checkpoint_path):
+        try:
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            checkpoint = {}
+        return {
+            'last_id': checkpoint.get('last_id', 0),
+            'failed': checkpoint.get('failed', []),
+        }
+
+    def save_checkpoint(self, checkpoint_path, checkpoint):
+        tmp_path = f'{checkpoint_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, checkpoint_path)
+
+    def sync_messages(self, chat_id, batch_size=500):
+        """Add the messages newer than the cached ones to the local cache."""
+        min_id = self.cache.max_id(chat_id)
+        synced = 0
         with self.client as client:
-            dialogs = client.get_dialogs()
+            batch = []
+            for message in client.iter_messages(chat_id, min_id=min_id, reverse=True):
+                batch.append(message)
+                if len(batch) >= batch_size:
+                    self.cache.store_messages(chat_id, batch)
+                    synced += len(batch)
+                    batch = []
+            self.cache.store_messages(chat_id, batch)
+            synced += len(batch)
+        self.cache.mark_synced(chat_id)
+        print(f'Synced {synced} new messages of chat_id {chat_id} after message {min_id}')
+        return synced
 
-            for dialog in dialogs:
+    def search_messages(self, chat_id, text, limit=10, refresh=None):
+        """Search the cached messages of a channel.
 
-                if dialog.is_channel \
-                    and dialog.id == id:
+        New messages are synced first when `refresh` is True, or by default
+        when the last sync is older than `sync_interval`. `refresh=False`
+        never touches the network.
+        """
+        if refresh is None:
+            synced_at = self.cache.synced_at(chat_id)
+            refresh = synced_at is None or time.time() - synced_at > self.sync_interval
+        if refresh:
+            self.sync_messages(chat_id)
+        return self.cache.search(chat_id, text, limit)
+
+    def search_message_by_text(self, chat_id, text):
+        matches = self.search_messages(chat_id, text)
+
+        for i, (message_id, _, message_text, file_name, _, _) in enumerate(matches):
+            print(f'{i} Found message ID: {message_id} Text: {message_text or file_name}')
+
+        if not matches:
+            raise ValueError(f'No messages matching {text!r} were found.')
+        # Ranked by relevance, the first one is the best match
+        message_id, _, message_text, file_name, _, _ = matches[0]
+        message_text = textwrap.shorten(
+            message_text or file_name or '', width=30, placeholder="...")
+
+        print(f'ID Message found: {message_id} with text: {message_text}')
+        return message_id
+
+    def get_dialogs(self, id=None, title=None):
+        """Input peer of a channel by id or title, from the cache when it was seen before."""
+        cached = self.cache.find_entity(id=id, title=title, kind='channel')
+        if cached is not None:
+            print(f'Found dialog in cache: {title or id}')
+            return cached
+
+        with self.client as client:
+            # Stop at the match instead of downloading the whole dialog list
+            for dialog in client.iter_dialogs():
+                self.cache.store_entity(dialog.id, dialog.entity)
+                if dialog.is_channel and (dialog.id == id or (title and dialog.title == title)):
                     print(f'Found dialog by id: {dialog.title} id: {dialog.id}')
-                    return dialog.entity
-                
+                    # The same type the cache returns
+                    return dialog.input_entity
+
     def get_me_channel(self):
         print('Getting me channel')
         with self.client as client:
@@ -1,20 +1,39 @@
+import time
+STARTUP_STARTED = time.monotonic()  # Imports are part of the time to ready
+
 import os
 import re
 import sys 
 import asyncio
 import logging
-from guessit import guessit
-import time
-from dataclasses import dataclass
+import json
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import contextlib
+import concurrent.futures
+import contextvars
+import heapq
+import itertools
+import importlib
+from datetime import datetime
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 from typing import Optional
-from functools import partial
-from telethon import TelegramClient, events
+from telethon import TelegramClient, events, Button
+from telethon.errors import FloodWaitError, InvalidBufferError
 from telethon.tl.types import MessageMediaDocument, DocumentAttributeFilename
 
 # Download queue and worker setup
-download_queue = asyncio.Queue()
-download_lock = asyncio.Lock()
+download_lock = asyncio.Lock()  # Guards active_downloads, not the downloads themselves
 active_downloads = {}
+# Telegram document id -> its queued or running DownloadTask
+downloads_by_document = {}
+current_worker = contextvars.ContextVar('current_worker', default=0)
+current_user = contextvars.ContextVar('current_user', default=None)
+# Pool connections used by the current download attempt, see ClientPool.acquire
+download_leases = contextvars.ContextVar('download_leases', default=None)
 
 @dataclass
 class DownloadTask:
@@ -25,7 +44,16 @@ class DownloadTask:
     msg: any = None
     queue_msg: any = None  # Store the queue message
     progress_callback: callable = None
+    progress: any = None  # ProgressEntry shown in the status message
     retry_count: int = 0
+    job_id: Optional[int] = None  # Row of the task in the download journal
+    batch: any = None  # DownloadBatch when the file belongs to an album
+    enqueued_at: float = 0.0
+    user_id: Optional[int] = None  # Telegram user the task is scheduled for
+    priority: int = 0  # Set with /prioridad, higher runs first among the user's files
+    sequence: int = 0  # Arrival order inside the scheduler
+    waiting_for_space: bool = False  # Deferred by DiskSpace, the user was told once
+    waiters: list = field(default_factory=list)  # Later messages with the same document
 
 if os.getenv('DEVELOPMENT'):
     from dotenv import load_dotenv
@@ -36,14 +64,355 @@ logging.basicConfig(
     level=logging.INFO
 )
 
-API_ID = int(os.getenv('API_ID'))
+# Checked by run_bot(), importing the module doesn't need credentials
+API_ID = int(os.getenv('API_ID') or 0)
 API_HASH = os.getenv('API_HASH')
-ALLOWED_USERS = os.getenv('ALLOWED_USERS', []).split(',')
+ALLOWED_USERS = os.getenv('ALLOWED_USERS', '').split(',')
+# Users allowed to run admin commands like /limite, all allowed users by default
+ADMIN_USERS = os.getenv('ADMIN_USERS', ','.join(ALLOWED_USERS)).split(',')
+# Parsed once, checked on every message
+ALLOWED_USER_IDS = frozenset(int(user) for user in ALLOWED_USERS if user.strip())
+ADMIN_USER_IDS = frozenset(int(user) for user in ADMIN_USERS if user.strip())
 DOWNLOAD_PATH = os.getenv('DOWNLOAD_PATH')
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+# Number of workers downloading in parallel from the main queue
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '2'))
+# Optional dedicated workers for small files, so they never wait behind big videos
+SMALL_DOWNLOAD_WORKERS = int(os.getenv('SMALL_DOWNLOAD_WORKERS', '0'))
+SMALL_FILE_MAX_MB = int(os.getenv('SMALL_FILE_MAX_MB', '50'))
+# Scheduler: run the smallest queued file of each user first, and cap downloads per user (0 = no cap)
+SMALL_FILES_FIRST = os.getenv('SMALL_FILES_FIRST', '').lower() in ('1', 'true', 'yes')
+PER_USER_MAX_ACTIVE = int(os.getenv('PER_USER_MAX_ACTIVE', '0'))
+# Extra bot sessions used only to download, each with its own connections
+DOWNLOAD_CLIENTS = int(os.getenv('DOWNLOAD_CLIENTS', '1'))
+# Parallel byte ranges fetched for a single large document
+DOWNLOAD_CONNECTIONS = int(os.getenv('DOWNLOAD_CONNECTIONS', '4'))
+# Documents smaller than this are downloaded as a single stream
+SEGMENTED_MIN_MB = int(os.getenv('SEGMENTED_MIN_MB', '20'))
+# Writer stage: buffer flushed per write, writer threads and fsync policy (part, close or none)
+WRITE_BUFFER_SIZE = int(os.getenv('WRITE_BUFFER_MB', '4')) * 1024 * 1024
+WRITER_THREADS = int(os.getenv('WRITER_THREADS', '2'))
+FSYNC_POLICY = os.getenv('FSYNC_POLICY', 'close')
+# Bandwidth shaping in MB/s (0 = unlimited), optionally per time window: "01:00-07:00=0,07:00-01:00=5"
+BANDWIDTH_LIMIT = float(os.getenv('BANDWIDTH_LIMIT_MB', '0')) * 1024 * 1024
+USER_BANDWIDTH_LIMIT = float(os.getenv('USER_BANDWIDTH_LIMIT_MB', '0')) * 1024 * 1024
+BANDWIDTH_SCHEDULE = os.getenv('BANDWIDTH_SCHEDULE', '')
+# Optional hard limit in seconds for one download attempt, 0 leaves it to the watchdog
+DOWNLOAD_TIMEOUT = int(os.getenv('DOWNLOAD_TIMEOUT', '0'))
+# A download is restarted after STALL_TIMEOUT seconds without bytes, when it stays
+# under STALL_MIN_SPEED_KB KB/s for STALL_WINDOW seconds, or when it takes
+# DEADLINE_SLACK times longer than its best observed speed would need
+STALL_TIMEOUT = float(os.getenv('STALL_TIMEOUT', '120'))
+STALL_MIN_SPEED = float(os.getenv('STALL_MIN_SPEED_KB', '0')) * 1024
+STALL_WINDOW = float(os.getenv('STALL_WINDOW', '60'))
+DEADLINE_SLACK = float(os.getenv('DEADLINE_SLACK', '4'))
+# Retries resuming from the .part file, the budget starts over after an attempt that saved parts
+DOWNLOAD_MAX_RETRIES = int(os.getenv('DOWNLOAD_MAX_RETRIES', '5'))
+DOWNLOAD_RETRY_DELAY = int(os.getenv('DOWNLOAD_RETRY_DELAY', '5'))
+# Retries of a single failed byte range while the other ranges keep downloading
+PART_MAX_RETRIES = int(os.getenv('PART_MAX_RETRIES', '3'))
+
+# Commands each user may send per second, with bursts of COMMAND_BURST
+COMMAND_RATE = float(os.getenv('COMMAND_RATE', '1'))
+COMMAND_BURST = float(os.getenv('COMMAND_BURST', '5'))
+
+# Seconds between edits of the download status messages
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', '3'))
+# Seconds between checks of the library folders for files added outside the bot
+CATALOG_SCAN_INTERVAL = float(os.getenv('CATALOG_SCAN_INTERVAL', '60'))
+LIBRARY_FOLDERS = ('Video', 'Music', 'Documents')
+# Pool used for guessit/mutagen work, "thread" or "process"
+METADATA_EXECUTOR = os.getenv('METADATA_EXECUTOR', 'thread')
+METADATA_WORKERS = int(os.getenv('METADATA_WORKERS', '2'))
+METADATA_CACHE_SIZE = int(os.getenv('METADATA_CACHE_SIZE', '4096'))
+METADATA_CACHE_TTL = float(os.getenv('METADATA_CACHE_TTL', '3600'))
+# Seconds to wait for more files of the same album before queueing it
+ALBUM_WINDOW = float(os.getenv('ALBUM_WINDOW', '2'))
+# ffmpeg actions run after a download, per file type: remux, audio, thumbnail
+POSTPROCESS_ACTIONS = {
+    'Video': [a for a in os.getenv('POSTPROCESS_VIDEO', '').split(',') if a],
+    'Music': [a for a in os.getenv('POSTPROCESS_MUSIC', '').split(',') if a],
+}
+POSTPROCESS_WORKERS = int(os.getenv('POSTPROCESS_WORKERS', str(os.cpu_count() or 1)))
+POSTPROCESS_TIMEOUT = int(os.getenv('POSTPROCESS_TIMEOUT', str(2 * 3600)))
+POSTPROCESS_KEEP_ORIGINAL = os.getenv('POSTPROCESS_KEEP_ORIGINAL', '').lower() in ('1', 'true', 'yes')
+# Thumbnails are kept outside the library folders, so /listar and /buscar don't show them
+THUMBNAIL_PATH = os.getenv('THUMBNAIL_PATH', os.path.join(DOWNLOAD_PATH or '.', 'Thumbnails'))
+# Optional Prometheus endpoint, disabled unless METRICS_PORT is set
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# SQLite journal that keeps the download queue across restarts
+QUEUE_DB_PATH = os.getenv('QUEUE_DB_PATH', os.path.join(DOWNLOAD_PATH or '.', '.geoffrey_queue.db'))
+
+# SQLite index of the library used to detect duplicates
+LIBRARY_DB_PATH = os.getenv('LIBRARY_DB_PATH', os.path.join(DOWNLOAD_PATH or '.', '.geoffrey_library.db'))
+# Free space kept on the download disk, and folders whose oldest files may be
+# deleted to make room for new downloads (e.g. "Video"), none by default
+DISK_MARGIN = int(float(os.getenv('DISK_MARGIN_MB', '512')) * 1024 * 1024)
+DISK_EVICT_FOLDERS = [f for f in os.getenv('DISK_EVICT_FOLDERS', '').split(',') if f]
+DISK_RETRY_DELAY = float(os.getenv('DISK_RETRY_DELAY', '60'))
+# SQLite full-text index used by /buscar
+SEARCH_DB_PATH = os.getenv('SEARCH_DB_PATH', os.path.join(DOWNLOAD_PATH or '.', '.geoffrey_search.db'))
+# SQLite manifest of the checksums computed while downloading, checked by /verificar
+CHECKSUM_DB_PATH = os.getenv('CHECKSUM_DB_PATH', os.path.join(DOWNLOAD_PATH or '.', '.geoffrey_checksums.db'))
+# Read speed of /verificar in MB/s, kept low so it doesn't compete with downloads (0 = unlimited)
+VERIFY_RATE = float(os.getenv('VERIFY_RATE_MB', '20')) * 1024 * 1024
+
+# Created and connected by main(), so the module can be imported offline
+client = None
+
+
+class DownloadJournal:
+    """Crash-safe record of queued and active downloads.
+
+    Every task is stored as (chat id, message id, filename, target path,
+    state) in a WAL mode SQLite database, so the queue can be replayed after
+    a restart. Rows are deleted once the download finishes, keeping the table
+    as small as the real backlog.
+    """
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db = sqlite3.connect(db_path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS downloads ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' chat_id INTEGER NOT NULL,'
+            ' message_id INTEGER NOT NULL,'
+            ' filename TEXT NOT NULL,'
+            ' download_path TEXT NOT NULL,'
+            " state TEXT NOT NULL DEFAULT 'queued',"
+            ' created_at REAL NOT NULL)'
+        )
+
+    def add(self, chat_id, message_id, filename, download_path):
+        """Store a new queued download and return its id."""
+        cursor = self.db.execute(
+            'INSERT INTO downloads (chat_id, message_id, filename, download_path, created_at)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            (chat_id, message_id, filename, download_path, time.time())
+        )
+        return cursor.lastrowid
+
+    def set_state(self, job_id, state):
+        self.db.execute('UPDATE downloads SET state = ? WHERE id = ?', (state, job_id))
+
+    def remove(self, job_id):
+        self.db.execute('DELETE FROM downloads WHERE id = ?', (job_id,))
+
+    def pending(self):
+        """Return the unfinished downloads in the order they were queued."""
+        return self.db.execute(
+            'SELECT id, chat_id, message_id, filename, download_path, state'
+            ' FROM downloads ORDER BY id'
+        ).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+download_journal = None  # Opened by open_storage()
+
+class DownloadScheduler:
+    """Queue of download tasks with per-user fairness.
+
+    Works like an `asyncio.Queue` for the workers, but instead of FIFO it
+    picks the next task by:
+
+    1. round-robin between the users with pending tasks,
+    2. within a user, their own priority (`/prioridad`), highest first,
+    3. then the smallest file first when SMALL_FILES_FIRST is set,
+       otherwise the oldest.
+
+    A priority only reorders the files of its user, so nobody can jump
+    ahead of other users by raising all of theirs.
+
+    Users already running PER_USER_MAX_ACTIVE downloads are skipped until one
+    of them finishes.
+    """
+
+    def __init__(self, small_first=SMALL_FILES_FIRST, per_user_cap=PER_USER_MAX_ACTIVE):
+        self.small_first = small_first
+        self.per_user_cap = per_user_cap
+        self.pending = {}  # user id -> heap of (sort key, task)
+        self.rotation = deque()  # users with pending tasks, next turn first
+        self.active = {}  # user id -> running downloads
+        self.sequence = itertools.count()
+        self.unfinished = 0
+        self.changed = asyncio.Condition()
+        self.all_done = asyncio.Event()
+        self.all_done.set()
+
+    def sort_key(self, task):
+        size = task.message.file.size if self.small_first else 0
+        return (-task.priority, size, task.sequence)
+
+    def qsize(self):
+        return sum(len(heap) for heap in self.pending.values())
+
+    async def put(self, task):
+        task.sequence = next(self.sequence)
+        heap = self.pending.setdefault(task.user_id, [])
+        if not heap and task.user_id not in self.rotation:
+            self.rotation.append(task.user_id)
+        heapq.heappush(heap, (self.sort_key(task), task))
+        self.unfinished += 1
+        self.all_done.clear()
+        async with self.changed:
+            self.changed.notify_all()
+
+    def pick(self, max_size=None):
+        """Choose the next task without waiting, or None."""
+        best = None
+        for user_id in self.rotation:
+            if self.per_user_cap and self.active.get(user_id, 0) >= self.per_user_cap:
+                continue
+            heap = self.pending[user_id]
+            if max_size is None:
+                entry = heap[0]
+            else:
+                small = [item for item in heap if item[1].message.file.size <= max_size]
+                if not small:
+                    continue
+                entry = min(small, key=lambda item: item[0])
+            best = (user_id, entry)
+            break
+
+        if best is None:
+            return None
 
-client = TelegramClient(
-    'geoffrey', API_ID, API_HASH).start(bot_token=BOT_TOKEN)
+        user_id, entry = best
+        heap = self.pending[user_id]
+        if heap[0] is entry:
+            heapq.heappop(heap)
+        else:
+            heap.remove(entry)
+            heapq.heapify(heap)
+
+        # The user goes to the back of the line for their next turn
+        self.rotation.remove(user_id)
+        if heap:
+            self.rotation.append(user_id)
+        else:
+            del self.pending[user_id]
+        self.active[user_id] = self.active.get(user_id, 0) + 1
+        return entry[1]
+
+    async def get(self, max_size=None):
+        """Wait for the next task, optionally only files up to `max_size` bytes."""
+        async with self.changed:
+            while True:
+                task = self.pick(max_size)
+                if task is not None:
+                    return task
+                await self.changed.wait()
+
+    def task_done(self, task):
+        self.active[task.user_id] = self.active.get(task.user_id, 1) - 1
+        self.unfinished -= 1
+        if self.unfinished <= 0:
+            self.all_done.set()
+        # A slot of a capped user was freed, let the waiting workers look again
+        asyncio.ensure_future(self.notify())
+
+    async def notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def join(self):
+        await self.all_done.wait()
+
+    def ordered(self):
+        """Pending tasks in the order they would be dispatched, ignoring caps."""
+        heaps = {user_id: list(heap) for user_id, heap in self.pending.items()}
+        rotation = deque(self.rotation)
+        order = []
+        while rotation:
+            user_id = rotation.popleft()
+            order.append(heapq.heappop(heaps[user_id])[1])
+            if heaps[user_id]:
+                rotation.append(user_id)
+        return order
+
+    def position(self, task):
+        """1-based position of a queued task in the dispatch order."""
+        for position, queued in enumerate(self.ordered(), 1):
+            if queued is task:
+                return position
+        return 0
+
+    async def set_priority(self, task, priority):
+        """Change the priority of a queued task."""
+        heap = self.pending.get(task.user_id, [])
+        for i, (_, queued) in enumerate(heap):
+            if queued is task:
+                task.priority = priority
+                heap[i] = (self.sort_key(task), task)
+                heapq.heapify(heap)
+                async with self.changed:
+                    self.changed.notify_all()
+                return True
+        return False
+
+    def user_tasks(self, user_id):
+        return [task for task in self.ordered() if task.user_id == user_id]
+
+
+download_queue = DownloadScheduler()
+
+async def enqueue_download(task):
+    """Record the task in the journal and schedule it."""
+    if task.job_id is None:
+        task.job_id = download_journal.add(
+            task.message.chat_id, task.message.id, task.filename, task.download_path)
+    if task.user_id is None:
+        task.user_id = task.message.sender_id or task.message.chat_id
+    task.enqueued_at = time.monotonic()
+    await download_queue.put(task)
+    return download_queue
+
+async def restore_download_queue():
+    """Re-fetch the messages of unfinished downloads and queue them again."""
+    rows = download_journal.pending()
+    if not rows:
+        return
+
+    by_chat = {}
+    for row in rows:
+        by_chat.setdefault(row[1], []).append(row)
+
+    restored = 0
+    for chat_id, chat_rows in by_chat.items():
+        # get_messages accepts up to 100 ids per request
+        for i in range(0, len(chat_rows), 100):
+            batch = chat_rows[i:i + 100]
+            try:
+                messages = await client.get_messages(chat_id, ids=[row[2] for row in batch])
+            except Exception as e:
+                print(f"Could not restore downloads from chat {chat_id}: {str(e)}")
+                continue
+
+            for (job_id, _, _, filename, download_path, _), message in zip(batch, messages):
+                if message is None or message.file is None:
+                    print(f"Dropping lost download {filename}: message no longer exists")
+                    download_journal.remove(job_id)
+                    continue
+
+                task = DownloadTask(
+                    message=message,
+                    filename=filename,
+                    download_path=download_path,
+                    event=None,
+                    job_id=job_id
+                )
+                disk_space.reserve(download_path, message.file.size)
+                downloads_by_document.setdefault(message.media.document.id, task)
+                await enqueue_download(task)
+                restored += 1
+
+    print(f"🔄 Restored {restored} downloads from the journal")
 
 def make_progress_bar(progress, total=100, length=20):
     percent = int(progress / total * 100)
@@ -51,84 +420,441 @@ def make_progress_bar(progress, total=100, length=20):
     bar = "█" * filled + "░" * (length - filled)
     return f"{bar} {percent}%"
 
-async def download_progress(msg_reply, downloading_txt, received_bytes, total):
-    # Initialize static variables if they don't exist
-    if not hasattr(download_progress, 'last_update'):
-        download_progress.last_update = {}
-    if not hasattr(download_progress, 'last_percent'):
-        download_progress.last_percent = {}
-    
-    # Use message ID as key to track progress per download
-    msg_id = id(msg_reply)
-    current_time = time.time()
-    current_percent = int((received_bytes / total) * 100) if total > 0 else 0
-    
-    # Only update if:
-    # 1. This is the first update for this message, or
-    # 2. At least 2 seconds have passed since last update, or
-    # 3. The progress has increased by at least 2%, or
-    # 4. The download is complete
-    last_update = download_progress.last_update.get(msg_id, 0)
-    last_percent = download_progress.last_percent.get(msg_id, -1)
-    
-    should_update = (
-        last_percent == -1 or  # First update
-        current_time - last_update >= 2.0 or  # At least 2 seconds since last update
-        current_percent >= last_percent + 2 or  # At least 2% progress
-        received_bytes >= total  # Download complete
-    )
-    
-    if should_update:
-        download_progress.last_update[msg_id] = current_time
-        download_progress.last_percent[msg_id] = current_percent
-        
-        # Generate progress bar
-        bar = make_progress_bar(received_bytes, total)
-        speed = ""
-        
-        # Add speed calculation if we have previous data
-        if hasattr(download_progress, 'last_bytes') and hasattr(download_progress, 'last_time'):
-            time_diff = current_time - download_progress.last_time
-            bytes_diff = received_bytes - download_progress.last_bytes
-            if time_diff > 0 and bytes_diff > 0:
-                speed_mb = (bytes_diff / (1024 * 1024)) / time_diff
-                speed = f"\n⚡ {speed_mb:.1f} MB/s"
-        
+class Histogram:
+    """Cumulative histogram rendered in the Prometheus text format."""
+
+    def __init__(self, name, help_text, buckets, labels=''):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.labels = labels  # e.g. 'command="/listar"', rendered before "le"
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.total += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def render(self, header=True):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"] if header else []
+        prefix = f'{self.labels},' if self.labels else ''
+        series = f'{{{self.labels}}}' if self.labels else ''
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum{series} {self.total}")
+        lines.append(f"{self.name}_count{series} {self.count}")
+        return lines
+
+
+class PipelineMetrics:
+    """Counters of the download pipeline exposed on an optional HTTP endpoint.
+
+    Recording a value is a couple of integer updates. Rates are computed by
+    `sample` every few seconds instead of per chunk, so the metrics can stay
+    on in production.
+    """
+
+    def __init__(self, sample_interval=5.0, alpha=0.3):
+        self.sample_interval = sample_interval
+        self.alpha = alpha
+        self.queue_wait = Histogram(
+            'geoffrey_queue_wait_seconds', 'Time a task waited in the queue.',
+            (1, 5, 15, 60, 300, 900, 3600, 4 * 3600))
+        self.time_to_first_byte = Histogram(
+            'geoffrey_time_to_first_byte_seconds', 'Time from download start to the first byte.',
+            (0.1, 0.25, 0.5, 1, 2, 5, 10, 30))
+        self.download_time = Histogram(
+            'geoffrey_download_duration_seconds', 'Total time of successful downloads.',
+            (1, 10, 30, 60, 300, 900, 1800, 3600, 4 * 3600))
+        self.worker_bytes = {}  # worker id -> bytes downloaded
+        self.worker_rates = {}  # worker id -> bytes per second
+        self.sampled_bytes = {}
+        self.sampled_at = time.monotonic()
+        self.downloads = {'completed': 0, 'failed': 0, 'timeout': 0}
+        self.stalls = 0
+        self.postprocess = {'completed': 0, 'failed': 0}
+        self.verified = {'ok': 0, 'corrupt': 0, 'missing': 0, 'error': 0}
+        self.flood_waits = 0
+        self.edit_errors = 0
+        self.startup_seconds = 0.0
+        self.command_latency = {}  # command -> Histogram
+        self.messages = {'accepted': 0, 'unauthorized': 0, 'throttled': 0}
+
+    def observe_command(self, command, seconds):
+        histogram = self.command_latency.get(command)
+        if histogram is None:
+            histogram = self.command_latency[command] = Histogram(
+                'geoffrey_command_duration_seconds', 'Time spent handling each command.',
+                (0.005, 0.025, 0.1, 0.25, 1, 5), labels=f'command="{command}"')
+        histogram.observe(seconds)
+
+    def add_bytes(self, worker_id, size):
+        self.worker_bytes[worker_id] = self.worker_bytes.get(worker_id, 0) + size
+
+    def sample(self):
+        now = time.monotonic()
+        elapsed = now - self.sampled_at
+        if elapsed <= 0:
+            return
+        for worker_id, total in self.worker_bytes.items():
+            current = (total - self.sampled_bytes.get(worker_id, 0)) / elapsed
+            previous = self.worker_rates.get(worker_id)
+            self.worker_rates[worker_id] = current if previous is None else (
+                self.alpha * current + (1 - self.alpha) * previous)
+            self.sampled_bytes[worker_id] = total
+        self.sampled_at = now
+
+    def render(self):
+        queued = download_queue.qsize()
+        lines = [
+            "# HELP geoffrey_queue_size Tasks waiting in the download queues.",
+            "# TYPE geoffrey_queue_size gauge",
+            f"geoffrey_queue_size {queued}",
+            "# HELP geoffrey_active_downloads Downloads currently running.",
+            "# TYPE geoffrey_active_downloads gauge",
+            f"geoffrey_active_downloads {len(active_downloads)}",
+            "# HELP geoffrey_downloaded_bytes_total Bytes downloaded per worker.",
+            "# TYPE geoffrey_downloaded_bytes_total counter",
+        ]
+        lines += [f'geoffrey_downloaded_bytes_total{{worker="{worker_id}"}} {total}'
+                  for worker_id, total in sorted(self.worker_bytes.items())]
+        lines += [
+            "# HELP geoffrey_download_bytes_per_second Smoothed download speed per worker.",
+            "# TYPE geoffrey_download_bytes_per_second gauge",
+        ]
+        lines += [f'geoffrey_download_bytes_per_second{{worker="{worker_id}"}} {rate:.0f}'
+                  for worker_id, rate in sorted(self.worker_rates.items())]
+        lines += [
+            "# HELP geoffrey_download_total_bytes_per_second Smoothed download speed of all workers.",
+            "# TYPE geoffrey_download_total_bytes_per_second gauge",
+            f"geoffrey_download_total_bytes_per_second {sum(self.worker_rates.values()):.0f}",
+            "# HELP geoffrey_downloads_total Finished downloads by result.",
+            "# TYPE geoffrey_downloads_total counter",
+        ]
+        lines += [f'geoffrey_downloads_total{{result="{result}"}} {count}'
+                  for result, count in self.downloads.items()]
+        lines += [
+            "# HELP geoffrey_postprocess_jobs_total Finished ffmpeg jobs by result.",
+            "# TYPE geoffrey_postprocess_jobs_total counter",
+        ]
+        lines += [f'geoffrey_postprocess_jobs_total{{result="{result}"}} {count}'
+                  for result, count in self.postprocess.items()]
+        lines += [
+            "# HELP geoffrey_verified_files_total Files checked by /verificar by result.",
+            "# TYPE geoffrey_verified_files_total counter",
+        ]
+        lines += [f'geoffrey_verified_files_total{{result="{result}"}} {count}'
+                  for result, count in self.verified.items()]
+        lines += [
+            "# HELP geoffrey_download_stalls_total Download attempts restarted by the stall watchdog.",
+            "# TYPE geoffrey_download_stalls_total counter",
+            f"geoffrey_download_stalls_total {self.stalls}",
+            "# HELP geoffrey_flood_waits_total FloodWait errors returned by Telegram.",
+            "# TYPE geoffrey_flood_waits_total counter",
+            f"geoffrey_flood_waits_total {self.flood_waits}",
+            "# HELP geoffrey_message_edit_errors_total Failed edits of status messages.",
+            "# TYPE geoffrey_message_edit_errors_total counter",
+            f"geoffrey_message_edit_errors_total {self.edit_errors}",
+            "# HELP geoffrey_startup_seconds Time from process start to accepting messages.",
+            "# TYPE geoffrey_startup_seconds gauge",
+            f"geoffrey_startup_seconds {self.startup_seconds:.3f}",
+            "# HELP geoffrey_messages_total Incoming messages by outcome.",
+            "# TYPE geoffrey_messages_total counter",
+        ]
+        lines += [f'geoffrey_messages_total{{result="{result}"}} {count}'
+                  for result, count in self.messages.items()]
+        for histogram in (self.queue_wait, self.time_to_first_byte, self.download_time):
+            lines += histogram.render()
+        for i, histogram in enumerate(self.command_latency.values()):
+            lines += histogram.render(header=i == 0)
+        return "\n".join(lines) + "\n"
+
+    async def handle_request(self, reader, writer):
         try:
-            await msg_reply.edit(
-                f"{downloading_txt}\n\n"
-                f"{bar}\n"
-                f"📊 {current_percent}% • {received_bytes/1024/1024:.1f}MB / {total/1024/1024:.1f}MB"
-                f"{speed}"
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Drain the headers, the path is the only thing that matters
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+
+            parts = request_line.decode(errors='replace').split()
+            if len(parts) >= 2 and parts[1] == '/metrics':
+                status, body = "200 OK", self.render()
+            else:
+                status, body = "404 Not Found", "Not found\n"
+
+            payload = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n".encode() + payload
             )
+            await writer.drain()
         except Exception as e:
-            if "message not modified" not in str(e).lower() and "A wait of" not in str(e):
-                print(f"Error updating progress: {str(e)}")
-    
-    # Update speed calculation data
-    download_progress.last_bytes = received_bytes
-    download_progress.last_time = current_time
-    
-    # Clean up progress tracking for completed downloads
-    if received_bytes >= total and msg_id in download_progress.last_update:
-        download_progress.last_update.pop(msg_id, None)
-        download_progress.last_percent.pop(msg_id, None)
-        
+            print(f"Error serving metrics: {str(e)}")
+        finally:
+            writer.close()
 
-def get_file_type(mime_type):
-    print(f"File type {mime_type}")
-    video_mime_types = ['video/mp4', 'video/x-msvideo', 'video/quicktime', 'video/x-matroska']
-    audio_mime_types = ['audio/mpeg', 'audio/vnd.wav', 'audio/x-flac']
-    document_mime_types = ['application/pdf', 'application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'application/vnd.ms-excel', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'application/vnd.ms-powerpoint', 'application/vnd.openxmlformats-officedocument.presentationml.presentation']
-
-    if mime_type in video_mime_types:
-        return 'Video'
-    elif mime_type in audio_mime_types:
-        return 'Music'
-    elif mime_type in document_mime_types:
-        return 'Documents'
-    else:
+    async def run(self, host=METRICS_HOST, port=METRICS_PORT):
+        server = await asyncio.start_server(self.handle_request, host, port)
+        print(f"📈 Metrics available on http://{host}:{port}/metrics")
+        async with server:
+            while True:
+                await asyncio.sleep(self.sample_interval)
+                self.sample()
+
+
+metrics = PipelineMetrics()
+
+class TokenBucket:
+    """Token bucket shared by concurrent consumers.
+
+    Each `consume` reserves its bytes on a virtual timeline and sleeps until
+    its turn, so concurrent downloads split the rate evenly without polling.
+    A rate of 0 means unlimited.
+    """
+
+    def __init__(self, rate=0, burst_seconds=1.0):
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self.next_free = time.monotonic()
+
+    def set_rate(self, rate):
+        self.rate = rate
+
+    async def consume(self, size):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        # Idle time accumulates at most `burst_seconds` worth of tokens
+        start = max(self.next_free, now - self.burst_seconds)
+        self.next_free = start + size / self.rate
+        delay = self.next_free - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def parse_bandwidth_schedule(value):
+    """Parse "HH:MM-HH:MM=MB/s,..." into [(start minute, end minute, bytes/s)]."""
+    schedule = []
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        window, rate = item.split('=')
+        start, end = window.split('-')
+        schedule.append((
+            int(start.split(':')[0]) * 60 + int(start.split(':')[1]),
+            int(end.split(':')[0]) * 60 + int(end.split(':')[1]),
+            float(rate) * 1024 * 1024
+        ))
+    return schedule
+
+
+class BandwidthShaper:
+    """Limits the download rate of all workers together and of each user.
+
+    The global limit comes, in order, from the admin override set with
+    `/limite`, the BANDWIDTH_SCHEDULE window matching the current time, or
+    BANDWIDTH_LIMIT_MB. It is re-evaluated every 30 seconds so schedules
+    apply without a restart.
+    """
+
+    def __init__(self, default_rate=BANDWIDTH_LIMIT, user_rate=USER_BANDWIDTH_LIMIT,
+                 schedule=BANDWIDTH_SCHEDULE):
+        self.default_rate = default_rate
+        self.user_rate = user_rate
+        self.schedule = parse_bandwidth_schedule(schedule)
+        self.override = None  # bytes/s set by an admin, None follows the schedule
+        self.bucket = TokenBucket(self.scheduled_rate())
+        self.user_buckets = {}
+        self.checked_at = time.monotonic()
+
+    def scheduled_rate(self):
+        now = datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.schedule:
+            inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if inside:
+                return rate
+        return self.default_rate
+
+    def current_rate(self):
+        return self.override if self.override is not None else self.scheduled_rate()
+
+    def set_override(self, rate):
+        self.override = rate
+        self.bucket.set_rate(self.current_rate())
+
+    def describe(self):
+        rate = self.bucket.rate
+        return f"{rate / (1024 * 1024):.1f} MB/s" if rate else "sin límite"
+
+    async def throttle(self, user_id, size):
+        now = time.monotonic()
+        if now - self.checked_at >= 30:
+            self.checked_at = now
+            self.bucket.set_rate(self.current_rate())
+
+        if self.user_rate:
+            bucket = self.user_buckets.get(user_id)
+            if bucket is None:
+                bucket = self.user_buckets[user_id] = TokenBucket(self.user_rate)
+            await bucket.consume(size)
+        await self.bucket.consume(size)
+
+
+bandwidth_shaper = BandwidthShaper()
+
+class ProgressEntry:
+    """Progress of one download, written by the download hot path."""
+
+    __slots__ = ('msg', 'text', 'total', 'received', 'note',
+                 'speed', 'sample_bytes', 'sample_time', 'rendered', 'rendered_state')
+
+    def __init__(self, msg, text, total):
+        self.msg = msg
+        self.text = text
+        self.total = total
+        self.received = 0
+        self.note = ''
+        self.speed = 0.0  # EWMA in bytes per second
+        self.sample_bytes = 0
+        self.sample_time = time.monotonic()
+        self.rendered = None
+        self.rendered_state = None
+
+    def update(self, received_bytes, total):
+        """Progress callback, only stores the numbers for the next tick."""
+        self.received = received_bytes
+        self.total = total
+
+
+class ProgressReporter:
+    """Edits the status message of every running download on a fixed tick.
+
+    Workers only post byte counts to their `ProgressEntry`. The reporter
+    computes an EWMA speed and ETA per entry and performs all the
+    `msg.edit` calls, pausing every edit when Telegram answers with a
+    FloodWait instead of letting each download hit the limit on its own.
+    """
+
+    def __init__(self, interval=PROGRESS_INTERVAL, alpha=0.3):
+        self.interval = interval
+        self.alpha = alpha
+        self.entries = set()
+        self.paused_until = 0
+
+    def track(self, msg, text, total):
+        entry = ProgressEntry(msg, text, total)
+        self.entries.add(entry)
+        return entry
+
+    def untrack(self, entry):
+        self.entries.discard(entry)
+
+    def sample(self, entry, now):
+        """Update the EWMA speed of an entry and return its ETA in seconds."""
+        elapsed = now - entry.sample_time
+        if elapsed > 0:
+            current = (entry.received - entry.sample_bytes) / elapsed
+            entry.speed = current if entry.speed == 0 else (
+                self.alpha * current + (1 - self.alpha) * entry.speed)
+        entry.sample_bytes = entry.received
+        entry.sample_time = now
+
+        if entry.speed > 0:
+            return (entry.total - entry.received) / entry.speed
         return None
+
+    def render(self, entry, eta):
+        received, total = entry.received, entry.total
+        percent = int((received / total) * 100) if total > 0 else 0
+        bar = make_progress_bar(received, total) if total > 0 else make_progress_bar(0)
+        speed = ""
+        if entry.speed > 0:
+            speed = f"\n⚡ {entry.speed / (1024 * 1024):.1f} MB/s"
+            if eta is not None:
+                speed += f" • ⏳ {format_eta(eta)}"
+        if bandwidth_shaper.bucket.rate:
+            speed += f"\n🚦 Límite: {bandwidth_shaper.describe()}"
+        note = f"\n\n{entry.note}" if entry.note else ""
+
+        return (
+            f"{entry.text}\n\n"
+            f"{bar}\n"
+            f"📊 {percent}% • {received/1024/1024:.1f}MB / {total/1024/1024:.1f}MB"
+            f"{speed}{note}"
+        )
+
+    async def tick(self):
+        now = time.monotonic()
+        if now < self.paused_until:
+            return
+
+        for entry in list(self.entries):
+            eta = self.sample(entry, now)
+            # Nothing new to show, don't spend an edit on a speed refresh
+            state = (entry.received, entry.total, entry.text, entry.note)
+            if state == entry.rendered_state:
+                continue
+
+            text = self.render(entry, eta)
+            if text == entry.rendered:
+                entry.rendered_state = state
+                continue
+
+            try:
+                await entry.msg.edit(text)
+                entry.rendered = text
+                entry.rendered_state = state
+            except FloodWaitError as e:
+                # Back off globally, every edit shares the same bot limits
+                self.paused_until = time.monotonic() + e.seconds
+                print(f"FloodWait: pausing progress updates for {e.seconds}s")
+                metrics.flood_waits += 1
+                return
+            except Exception as e:
+                entry.rendered = text
+                entry.rendered_state = state
+                if "message not modified" not in str(e).lower():
+                    metrics.edit_errors += 1
+                    print(f"Error updating progress: {str(e)}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except Exception as e:
+                print(f"Error in progress reporter: {str(e)}")
+
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60}s"
+    return f"{seconds}s"
+
+
+progress_reporter = ProgressReporter()
+
+# Library folder of each supported MIME type
+MIME_TYPE_FOLDERS = {
+    **dict.fromkeys(['video/mp4', 'video/x-msvideo', 'video/quicktime', 'video/x-matroska'], 'Video'),
+    **dict.fromkeys(['audio/mpeg', 'audio/vnd.wav', 'audio/x-flac'], 'Music'),
+    **dict.fromkeys(['application/pdf', 'application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'application/vnd.ms-excel', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'application/vnd.ms-powerpoint', 'application/vnd.openxmlformats-officedocument.presentationml.presentation'], 'Documents'),
+}
+
+def get_file_type(mime_type):
+    return MIME_TYPE_FOLDERS.get(mime_type)
     
 def check_filename_type(filename):
     # Detectar tipo de archivo
@@ -139,12 +865,25 @@ def check_filename_type(filename):
 def check_filename_exists(download_filename):
     return os.path.exists(download_filename)
 
+lazy_modules = {}
+
+def lazy_import(name):
+    """Import an optional heavy module on first use, None if it is not installed."""
+    if name not in lazy_modules:
+        try:
+            lazy_modules[name] = importlib.import_module(name)
+        except ImportError:
+            lazy_modules[name] = None
+    return lazy_modules[name]
+
 def get_mp3_metadata(file_path):
     try:
-        from mutagen.easyid3 import EasyID3
-        from mutagen.mp3 import MP3
+        easyid3 = lazy_import('mutagen.easyid3')
+        mp3 = lazy_import('mutagen.mp3')
+        if easyid3 is None or mp3 is None:
+            raise ImportError('mutagen')
 
-        audio = MP3(file_path, ID3=EasyID3)
+        audio = mp3.MP3(file_path, ID3=easyid3.EasyID3)
         title = audio.get('title', ['Unknown Title'])[0]
         artist = audio.get('artist', ['Unknown Artist'])[0]
         album = audio.get('album', ['Unknown Album'])[0]
@@ -174,318 +913,2517 @@ async def show_help(event):
     `/listar music` o `/list music` - Muestra archivos de música
     `/listar document` o `/list document` - Muestra documentos
 
+    🔎 *Buscar:*
+    `/buscar <texto>` - Busca por nombre, título, episodio (`s01e02`), artista o álbum
+
+    💾 *Espacio:*
+    `/espacio` - Muestra el espacio usado por carpeta y el disponible
+
+    🚦 *Prioridad:*
+    `/prioridad` - Muestra tus archivos en cola
+    `/prioridad <número o nombre> [alta|normal|baja]` - Cambia su orden entre tus archivos
+
+    🚦 *Límite de descarga (administradores):*
+    `/limite` - Muestra el límite actual
+    `/limite <MB/s>` - Cambia el límite, `0` lo quita y `auto` vuelve al horario
+
+    🔍 *Verificar archivos (administradores):*
+    `/verificar` - Comprueba en segundo plano que los archivos descargados no estén dañados
+
     ❓ *Ayuda:*
     `/help` o `/ayuda` - Muestra este mensaje de ayuda
     """
     await event.reply(help_text, parse_mode='markdown')
 
 
-async def list_files_by_type(event, file_type):
-    """List files in the specified folder by type."""
-    try:
-        # Map user-friendly type to folder name
-        type_to_folder = {
-            'video': 'Video',
-            'music': 'Music',
-            'document': 'Documents',
-            'videos': 'Video',
-            'musics': 'Music',
-            'documentos': 'Documents',
-            'documento': 'Documents',
-            'música': 'Music',
-            'músicas': 'Music',
-            'cancion': 'Music',
-            'canciones': 'Music',
-            'vídeo': 'Video',
-            'vídeos': 'Video'
-        }
-        
-        folder_name = type_to_folder.get(file_type.lower())
-        if not folder_name:
-            await event.reply(
-                "❌ Tipo de archivo no válido.\n\n"
-                "📋 Usa uno de estos comandos:\n"
-                "/listar video - Muestra archivos de video\n"
-                "/listar music - Muestra archivos de música\n"
-                "/listar document - Muestra documentos"
-            )
-            return
-            
-        folder_path = os.path.join(DOWNLOAD_PATH, folder_name)
-        
-        if not os.path.exists(folder_path):
-            await event.reply(f"❌ No se encontró la carpeta para {folder_name}")
+def format_size(size_bytes):
+    if size_bytes == 0:
+        return "0B"
+    size_names = ("B", "KB", "MB", "GB", "TB")
+    i = 0
+    while size_bytes >= 1024 and i < len(size_names) - 1:
+        size_bytes /= 1024
+        i += 1
+    return f"{size_bytes:.1f}{size_names[i]}"
+
+
+class LibraryCatalog:
+    """In-memory index of the downloaded files per type folder.
+
+    Built with a single `os.scandir` pass at startup and kept up to date by
+    `add` when a download finishes and by `watch`, which only rescans a
+    folder when its modification time changes. `/listar` is served from
+    here without touching the disk.
+    """
+
+    def __init__(self, root, folders=LIBRARY_FOLDERS):
+        self.root = root
+        self.folders = folders
+        self.files = {}  # folder -> {name: (size, mtime)}
+        self.folder_mtimes = {}
+        self.sorted_cache = {}
+
+    def scan_folder(self, folder):
+        folder_path = os.path.join(self.root, folder)
+        try:
+            folder_mtime = os.stat(folder_path).st_mtime
+            files = {}
+            with os.scandir(folder_path) as it:
+                for entry in it:
+                    if not self.is_library_file(entry.name) or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    files[entry.name] = (stat.st_size, stat.st_mtime)
+        except FileNotFoundError:
+            self.files.pop(folder, None)
+            self.folder_mtimes.pop(folder, None)
+            self.sorted_cache.pop(folder, None)
             return
-            
-        files = [f for f in os.listdir(folder_path) 
-                if os.path.isfile(os.path.join(folder_path, f))]
-        
-        if not files:
-            await event.reply(f"📂 La carpeta de {folder_name} está vacía")
+
+        self.files[folder] = files
+        self.folder_mtimes[folder] = folder_mtime
+        self.sorted_cache.pop(folder, None)
+
+    def build(self):
+        for folder in self.folders:
+            self.scan_folder(folder)
+
+    def refresh(self):
+        """Rescan the folders whose modification time changed."""
+        for folder in self.folders:
+            try:
+                folder_mtime = os.stat(os.path.join(self.root, folder)).st_mtime
+            except FileNotFoundError:
+                folder_mtime = None
+            if folder_mtime != self.folder_mtimes.get(folder):
+                self.scan_folder(folder)
+
+    @staticmethod
+    def is_library_file(name):
+        # Skip hidden files and downloads still in progress
+        return not name.startswith('.') and not name.endswith(('.part', '.part.json'))
+
+    def add(self, file_path):
+        """Register a file that was just written to the library."""
+        folder = os.path.basename(os.path.dirname(file_path))
+        if folder not in self.folders:
             return
-            
-        # Sort files by modification time (newest first)
-        files.sort(key=lambda x: os.path.getmtime(os.path.join(folder_path, x)), reverse=True)
-        
-        # Format file sizes
-        def format_size(size_bytes):
-            if size_bytes == 0:
-                return "0B"
-            size_names = ("B", "KB", "MB", "GB", "TB")
-            i = 0
-            while size_bytes >= 1024 and i < len(size_names) - 1:
-                size_bytes /= 1024
-                i += 1
-            return f"{size_bytes:.1f}{size_names[i]}"
-
-        # Split files into chunks to avoid message length limits
-        chunk_size = 10
-        file_chunks = [files[i:i + chunk_size] for i in range(0, len(files), chunk_size)]
-        
-        for i, chunk in enumerate(file_chunks, 1):
-            file_list = []
-            for file in chunk:
-                file_path = os.path.join(folder_path, file)
-                file_size = format_size(os.path.getsize(file_path))
-                file_list.append(f"• `{file}` ({file_size})")
-                
-            await event.reply(
-                f"📂 **Archivos en {folder_name}**\n\n" +
-                "\n".join(file_list) + 
-                f"\n\n📋 Página {i}/{len(file_chunks)} • Total: {len(files)} archivos"
+        stat = os.stat(file_path)
+        self.files.setdefault(folder, {})[os.path.basename(file_path)] = (stat.st_size, stat.st_mtime)
+        self.sorted_cache.pop(folder, None)
+
+    def remove(self, file_path):
+        folder = os.path.basename(os.path.dirname(file_path))
+        if self.files.get(folder, {}).pop(os.path.basename(file_path), None) is not None:
+            self.sorted_cache.pop(folder, None)
+
+    def has_folder(self, folder):
+        return folder in self.files
+
+    def sorted_files(self, folder):
+        """Return [(name, size, mtime)] for a folder, newest first."""
+        files = self.sorted_cache.get(folder)
+        if files is None:
+            files = sorted(
+                ((name, size, mtime) for name, (size, mtime) in self.files.get(folder, {}).items()),
+                key=lambda item: item[2],
+                reverse=True
             )
-            
-    except Exception as e:
-        await event.reply(f"❌ Error al listar archivos: {str(e)}")
-        print(f"Error listing files: {str(e)}")
+            self.sorted_cache[folder] = files
+        return files
 
-def guess_filename(filename):
-    """Guess file information using guessit."""
-    try:
-        import guessit
-        info = guessit.guessit(filename)
-        return info
-    except ImportError:
+    async def watch(self, interval=CATALOG_SCAN_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                print(f"Error refreshing library catalog: {str(e)}")
+
+
+library_catalog = LibraryCatalog(DOWNLOAD_PATH)
+
+PARTIAL_HASH_BLOCK = 64 * 1024
+
+def partial_hash_blocks(size):
+    """Offsets of the head and tail blocks used for the partial hash."""
+    tail = max(0, (size - 1) // PARTIAL_HASH_BLOCK * PARTIAL_HASH_BLOCK)
+    return [0] if tail == 0 else [0, tail]
+
+def partial_hash(size, blocks):
+    digest = hashlib.sha256(str(size).encode())
+    for block in blocks:
+        digest.update(block)
+    return digest.hexdigest()
+
+def partial_hash_file(file_path):
+    """Partial hash of a file on disk, reading only its head and tail blocks."""
+    size = os.path.getsize(file_path)
+    blocks = []
+    with open(file_path, 'rb') as f:
+        for offset in partial_hash_blocks(size):
+            f.seek(offset)
+            blocks.append(f.read(PARTIAL_HASH_BLOCK))
+    return partial_hash(size, blocks)
+
+async def partial_hash_remote(message):
+    """Partial hash of a Telegram document, fetching only its head and tail blocks."""
+    document = message.media.document
+    blocks = []
+    for offset in partial_hash_blocks(document.size):
+        block = b''
+        async for chunk in message.client.iter_download(
+                document,
+                offset=offset,
+                limit=1,
+                request_size=PARTIAL_HASH_BLOCK,
+                file_size=document.size):
+            block = bytes(chunk)
+        blocks.append(block)
+    return partial_hash(document.size, blocks)
+
+
+class LibraryIndex:
+    """Persistent index of library files by Telegram document and content.
+
+    Files are keyed by document id/access hash and by (size, partial hash),
+    where the partial hash covers the size plus the first and last 64KB.
+    It lets the handler recognise a file we already have before any byte
+    of it is downloaded.
+    """
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # Shared with the threads that hash files off the event loop
+        self.db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            ' path TEXT PRIMARY KEY,'
+            ' document_id INTEGER,'
+            ' access_hash INTEGER,'
+            ' size INTEGER NOT NULL,'
+            ' partial_hash TEXT NOT NULL,'
+            ' added_at REAL NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_document ON files (document_id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_content ON files (size, partial_hash)')
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def add(self, file_path, document=None, digest=None):
+        """Index a library file, hashing it from disk when no digest is given."""
+        size = os.path.getsize(file_path)
+        digest = digest or partial_hash_file(file_path)
+        self.execute(
+            'INSERT OR REPLACE INTO files (path, document_id, access_hash, size, partial_hash, added_at)'
+            ' VALUES (?, ?, ?, ?, ?, ?)',
+            (file_path,
+             document.id if document else None,
+             document.access_hash if document else None,
+             size, digest, time.time())
+        )
+
+    def remove(self, file_path):
+        self.execute('DELETE FROM files WHERE path = ?', (file_path,))
+
+    def existing(self, rows):
+        """Return the first path of `rows` still on disk, forgetting stale ones."""
+        for (file_path,) in rows:
+            if os.path.exists(file_path):
+                return file_path
+            self.remove(file_path)
         return None
 
-async def download_worker():
-    """Worker that processes download tasks from the queue."""
-    while True:
-        task = await download_queue.get()
-        task_id = id(task)
-        
-        try:
-            async with download_lock:
-                if task_id in active_downloads:
-                    return  # Skip if task is already being processed
-                    
-                active_downloads[task_id] = task
-                
-                # Create progress message
-                queue_size = download_queue.qsize()
-                downloading_txt = (
-                    f"⬇️ **En cola: {queue_size}**\n"
-                    f"**Descargando:** `{task.filename}`\n"
-                    f"💾 Tamaño: {task.message.file.size/1024/1024:.1f}MB"
-                )
-                
-                try:
-                    task.msg = await task.event.reply(downloading_txt)
-                    
-                    # Download the file with progress callback
-                    task.progress_callback = partial(
-                        download_progress, 
-                        task.msg, 
-                        downloading_txt
-                    )
-                    
-                    # Add timeout to prevent hanging on slow downloads
-                    download_task = asyncio.create_task(
-                        task.message.download_media(
-                            file=task.download_path,
-                            progress_callback=task.progress_callback
-                        )
-                    )
-                    
-                    # Wait for download to complete with timeout (6 hours)
-                    await asyncio.wait_for(download_task, timeout=6*3600)
-                    
-                    # Update message when download is complete
-                    file_size = os.path.getsize(task.download_path)
-                    
-                    completion_msg = await task.msg.reply(
-                        "✅ **Descarga completada**\n"
-                        f"📁 `{task.filename}`\n"
-                        f"💾 Tamaño: {file_size/1024/1024:.1f}MB\n"
-                        f"📂 Guardado en: `{task.download_path}`"
-                    )
-                    print(f'\n✅ Downloaded to {task.download_path}')
-                    
-                    # Delete the progress and queue messages after a short delay
-                    await asyncio.sleep(2)  # Give user time to see the completion message
-                    try:
-                        await task.msg.delete()
-                    except Exception as e:
-                        print(f"Could not delete progress message: {str(e)}")
-                    
+    def find_document(self, document):
+        return self.existing(self.execute(
+            'SELECT path FROM files WHERE document_id = ? AND access_hash = ?',
+            (document.id, document.access_hash)
+        ))
+
+    def find_content(self, size, digest):
+        return self.existing(self.execute(
+            'SELECT path FROM files WHERE size = ? AND partial_hash = ?',
+            (size, digest)
+        ))
+
+    def has_size(self, size):
+        return bool(self.execute('SELECT 1 FROM files WHERE size = ? LIMIT 1', (size,)))
+
+    def index_catalog_size(self, catalog, size):
+        """Hash the catalog files of a given size that are not indexed yet."""
+        for folder in catalog.folders:
+            # Snapshot, the event loop keeps updating the catalog meanwhile
+            for name, (file_size, _) in list(dict(catalog.files.get(folder, {})).items()):
+                file_path = os.path.join(catalog.root, folder, name)
+                if file_size != size:
+                    continue
+                known = self.execute('SELECT 1 FROM files WHERE path = ?', (file_path,))
+                if not known:
                     try:
-                        print(task.queue_msg)
-                        if task.queue_msg:
-                            await task.queue_msg.delete()
-                    except Exception as e:
-                        print(f"Could not delete queue message: {str(e)}")
-                    
-                except asyncio.TimeoutError:
-                    error_msg = (
-                        f"⏱️ **Tiempo de espera agotado**\n"
-                        f"`{task.filename}`\n"
-                        "La descarga tomó demasiado tiempo. Inténtalo de nuevo más tarde."
-                    )
-                    print(f'\n❌ Download timed out: {task.filename}')
-                    if task.msg:
-                        await task.msg.edit(error_msg)
-                        
-                except Exception as e:
-                    error_msg = (
-                        f"❌ **Error al descargar**\n"
-                        f"`{task.filename}`\n"
-                        f"Error: {str(e)}"
-                    )
-                    print(f'\n❌ Error downloading {task.filename}: {str(e)}')
-                    if task.msg:
-                        await task.msg.edit(error_msg)
-                    
-        except Exception as e:
-            print(f"\n❌ Error in download worker: {str(e)}")
-            
-        finally:
-            active_downloads.pop(task_id, None)
-            download_queue.task_done()
-            # Small delay to prevent rate limiting
-            await asyncio.sleep(1)
+                        self.add(file_path)
+                    except OSError:
+                        pass
 
-def guess_filename(filename):
-    """Guess file information using guessit."""
-    try:
-        import guessit
-        info = guessit.guessit(filename)
 
-        extension = info.get('container') if info.get('container') is not None else filename.split(".")[-1]
+library_index = None  # Opened by open_storage()
 
-        episode = f"E{info.get('episode')}" if info.get('episode') is not None else ""
+class SearchIndex:
+    """Persistent full-text index of the library behind /buscar.
 
-        season = ''
+    An SQLite FTS5 table holds, per file, its name split into words, the
+    title guessed by guessit or read from the ID3 tags, and extra terms
+    like "s01e02", the artist or the album. Accents and case are ignored.
+    `sync` only parses files whose size or mtime changed since the last
+    run, and `add` indexes a download as soon as it finishes, so queries
+    never touch the disk.
+    """
 
-        if info.get('episode') is not None:
-            season = f"S{info.get('season')}" if info.get('season') is not None else 'S0'
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS documents ('
+            ' id INTEGER PRIMARY KEY,'
+            ' path TEXT UNIQUE NOT NULL,'
+            ' folder TEXT NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' mtime REAL NOT NULL)'
+        )
+        self.db.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS terms USING fts5('
+            " name, title, extra, tokenize='unicode61 remove_diacritics 2')"
+        )
 
-        return f"{info.get('title')} - {season}{episode}.{extension}"
-    except ImportError:
-        print("guessit not installed")
-        return None
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
 
-def clean_string(s):
-    """Clean string for filename usage."""
-    return s.strip().replace('/', '_').replace('\\', '_').replace('\n', '_').replace('\r', '_').replace(':', '_')
+    def close(self):
+        with self.lock:
+            self.db.close()
 
-async def main():
-    # Start download workers
-    num_workers = 2  # You can increase this for parallel downloads
-    workers = [asyncio.create_task(download_worker()) for _ in range(num_workers)]
-    
-    # Handler para mensajes nuevos
-    @client.on(events.NewMessage)
-    async def handler(event):
-        if event.sender_id not in list(map(int, ALLOWED_USERS)):
-            await event.reply("No tienes permisos para usar este bot.")
-            return
-    
-        message_text = (event.message.text or "").strip().lower()
-        
-        # Handle help command
-        if message_text in ['/help', '/ayuda', '/start']:
-            await show_help(event)
-            return
-        
-        # Handle list command
-        if message_text.lower().startswith(('/listar', '/list', '/l')):
-            parts = message_text.split(maxsplit=1)
-            if len(parts) > 1:
-                await list_files_by_type(event, parts[1].strip())
-            else:
-                # Show help for list command
-                await event.reply(
-                    "📋 **Lista de archivos disponibles**\n\n"
-                    "Usa uno de estos comandos:\n"
-                    "`/listar video` - Muestra archivos de video\n"
-                    "`/listar music` - Muestra archivos de música\n"
-                    "`/listar document` - Muestra documentos\n\n"
-                    "*Sugerencia:* Usa `/l` en lugar de `/listar` para ahorrar tiempo.\n"
-                    "Ejemplo: `/l video`"
-                )
-            return
+    @staticmethod
+    def describe(file_path):
+        """Searchable (name, title, extra) text of a library file."""
+        name = os.path.basename(file_path)
+        words = re.sub(r'[._\-\[\]()]+', ' ', os.path.splitext(name)[0])
+        title, extra = '', []
 
-        print("📥 Nuevo mensaje en Geoffrey:", message_text)
-
-        if isinstance(event.message.media, MessageMediaDocument):
-            attr_filename = ''
-            filename = ''
-            
-            for attr in event.message.media.document.attributes:
-                if isinstance(attr, DocumentAttributeFilename):
-                    attr_filename = attr.file_name
-                    print(f'Original filename: {attr_filename}')
-                    break
-
-            # Check file type
-            file_type = get_file_type(event.message.media.document.mime_type)
-            
-            if not file_type:
-                await event.reply(f"❌ Tipo de archivo no soportado {file_type}. Solo se permiten videos, audios y documentos.")
-                return
+        guessit = lazy_import('guessit')
+        if guessit is not None:
+            info = guessit.guessit(name)
+            title = str(info.get('title', ''))
+            if info.get('episode_title'):
+                extra.append(str(info['episode_title']))
+            season, episode = info.get('season'), info.get('episode')
+            if isinstance(season, int) and isinstance(episode, int):
+                extra.append(f"s{season:02}e{episode:02} e{episode:02}")
+            for key in ('season', 'episode', 'year'):
+                if isinstance(info.get(key), int):
+                    extra.append(f"{key} {info[key]}")
 
-            filename = attr_filename
+        if name.lower().endswith('.mp3'):
+            tags = get_mp3_metadata(file_path)
+            if tags:
+                title = tags['title'] if tags['title'] != 'Unknown Title' else title
+                extra += [value for value in (tags['artist'], tags['album'])
+                          if not value.startswith('Unknown')]
 
-            if file_type == "Video":
-                # Replace name whether the file is a Video
-                filename = f"{message_text} - {attr_filename}" if message_text else attr_filename
-                filename = guess_filename(clean_string(filename))
-            
-            # Clean filename    
-            filename = clean_string(filename)
+        return words, title, ' '.join(value for value in extra if value)
 
-            print("Final Filename", filename)
+    def add(self, file_path, stat=None):
+        stat = stat or os.stat(file_path)
+        name, title, extra = self.describe(file_path)
+        folder = os.path.basename(os.path.dirname(file_path))
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                self.remove_locked(file_path)
+                cursor = self.db.execute(
+                    'INSERT INTO documents (path, folder, size, mtime) VALUES (?, ?, ?, ?)',
+                    (file_path, folder, stat.st_size, stat.st_mtime))
+                self.db.execute(
+                    'INSERT INTO terms (rowid, name, title, extra) VALUES (?, ?, ?, ?)',
+                    (cursor.lastrowid, name, title, extra))
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
 
-            # Create download directory if it doesn't exist
-            download_dir = f'{DOWNLOAD_PATH}/{file_type}'
-            os.makedirs(download_dir, exist_ok=True)
-            download_path = f'{download_dir}/{filename}'
+    def remove_locked(self, file_path):
+        row = self.db.execute('SELECT id FROM documents WHERE path = ?', (file_path,)).fetchone()
+        if row:
+            self.db.execute('DELETE FROM terms WHERE rowid = ?', row)
+            self.db.execute('DELETE FROM documents WHERE id = ?', row)
 
-            # Check if file already exists
-            if check_filename_exists(download_path):
-                await event.reply(f"❌ El archivo {filename} ya existe en el servidor. Por favor, cambia el nombre del archivo e intenta de nuevo.")
-                return
+    def remove(self, file_path):
+        with self.lock:
+            self.remove_locked(file_path)
 
-            # Create download task and add to queue
-            task = DownloadTask(
-                message=event.message,
-                filename=filename,
-                download_path=download_path,
-                event=event
-            )
-            
-            await download_queue.put(task)
-            queue_size = download_queue.qsize()
-            
-            # Notify user that the download is queued and store the message
-            task.queue_msg = await event.reply(
-                f"📥 **Archivo agregado a la cola**\n"
-                f"📄 `{filename}`\n"
-                f"🔄 Posición en cola: {queue_size}"
-            )
+    def sync(self, catalog):
+        """Index new or changed catalog files and forget the ones that are gone."""
+        indexed = {path: (size, mtime) for path, size, mtime
+                   in self.execute('SELECT path, size, mtime FROM documents')}
+        current = {}
+        for folder in catalog.folders:
+            for name, (size, mtime) in dict(catalog.files.get(folder, {})).items():
+                current[os.path.join(catalog.root, folder, name)] = (size, mtime)
 
-    # Mantener el cliente corriendo
-    await client.run_until_disconnected()
+        for file_path in indexed.keys() - current.keys():
+            self.remove(file_path)
+
+        added = 0
+        for file_path, (size, mtime) in current.items():
+            if indexed.get(file_path) == (size, mtime):
+                continue
+            try:
+                self.add(file_path, os.stat_result((0, 0, 0, 0, 0, 0, size, 0, mtime, 0)))
+                added += 1
+            except Exception as e:
+                print(f"Could not index {file_path} for search: {str(e)}")
+        return added
+
+    @staticmethod
+    def match_expression(query):
+        """FTS5 query where every word must appear, as a whole word or a prefix."""
+        words = re.findall(r'\w+', query.lower())
+        return ' '.join(f'"{word}"*' for word in words)
+
+    def search(self, query, limit, offset=0):
+        """Return (total, [(path, folder, size)]) ranked by relevance."""
+        expression = self.match_expression(query)
+        if not expression:
+            return 0, []
+        total = self.execute('SELECT count(*) FROM terms WHERE terms MATCH ?', (expression,))[0][0]
+        rows = self.execute(
+            'SELECT documents.path, documents.folder, documents.size FROM terms'
+            ' JOIN documents ON documents.id = terms.rowid'
+            ' WHERE terms MATCH ?'
+            ' ORDER BY bm25(terms, 1.0, 4.0, 2.0) LIMIT ? OFFSET ?',
+            (expression, limit, offset))
+        return total, rows
+
+    async def watch(self, catalog, interval=CATALOG_SCAN_INTERVAL):
+        """Keep the index in step with the catalog, which watches the disk."""
+        while True:
+            try:
+                added = await asyncio.to_thread(self.sync, catalog)
+                if added:
+                    print(f"🔎 Indexed {added} files for search")
+            except Exception as e:
+                print(f"Error updating search index: {str(e)}")
+            await asyncio.sleep(interval)
+
+
+search_index = None  # Opened by open_storage()
+
+class DiskSpace:
+    """Admission control for downloads based on the free space of the disk.
+
+    Every queued or active download reserves the bytes it still has to
+    allocate, its size until its `.part` file has been preallocated. A new
+    file is admitted when it fits in the free space reported by `statvfs`
+    minus those reservations and DISK_MARGIN. When the disk itself is short,
+    the oldest files of DISK_EVICT_FOLDERS are deleted to make room. A file
+    that only fails because of other reservations is deferred, nothing is
+    deleted for it until it is about to start, and one bigger than the free
+    space is rejected. A deferred file may start once it fits next to the
+    downloads already running, queued ones don't hold it back.
+
+    Reservations are only touched from the event loop and kept as running
+    totals, so no `.part` file is statted. `statvfs` and deleting files run
+    in threads.
+    """
+
+    def __init__(self, root, margin=DISK_MARGIN, evict_folders=DISK_EVICT_FOLDERS):
+        self.root = root
+        self.margin = margin
+        self.evict_folders = evict_folders
+        self.reservations = {}  # download path -> bytes not allocated yet
+        self.running = set()  # Reserved paths whose download has started
+        self.reserved_total = 0
+        self.running_total = 0
+        self.evicting = asyncio.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def statvfs(self):
+        stat = os.statvfs(self.root)
+        return stat.f_blocks * stat.f_frsize, stat.f_bavail * stat.f_frsize
+
+    def free(self):
+        return self.statvfs()[1]
+
+    def reserve(self, download_path, size):
+        """Reserve `size` bytes for a download, replacing its previous reservation."""
+        self.release(download_path)
+        self.reservations[download_path] = size
+        self.reserved_total += size
+
+    def allocated(self, download_path):
+        """The `.part` file was preallocated, its bytes are already off the free space."""
+        size = self.reservations.get(download_path)
+        if not size:
+            return
+        self.reservations[download_path] = 0
+        self.reserved_total -= size
+        if download_path in self.running:
+            self.running_total -= size
+
+    def start(self, download_path):
+        if download_path in self.reservations and download_path not in self.running:
+            self.running.add(download_path)
+            self.running_total += self.reservations[download_path]
+
+    def release(self, download_path):
+        size = self.reservations.pop(download_path, None)
+        if size is None:
+            return
+        self.reserved_total -= size
+        if download_path in self.running:
+            self.running.discard(download_path)
+            self.running_total -= size
+
+    def eviction_candidates(self):
+        """[(mtime, path, size)] of the evictable files not reserved, oldest first."""
+        return sorted(
+            (mtime, os.path.join(library_catalog.root, folder, name), size)
+            for folder in self.evict_folders
+            for name, (size, mtime) in dict(library_catalog.files.get(folder, {})).items()
+            if os.path.join(library_catalog.root, folder, name) not in self.reservations
+        )
+
+    def remove_oldest(self, candidates, needed):
+        """Delete `candidates` in order until `needed` more bytes are free, in a thread."""
+        target = self.free() + needed
+        evicted = []
+        for _, file_path, _ in candidates:
+            if self.free() >= target:
+                break
+            try:
+                os.remove(file_path)
+            except OSError as e:
+                print(f"Could not evict {file_path}: {str(e)}")
+                continue
+            library_index.remove(file_path)
+            search_index.remove(file_path)
+            checksum_manifest.remove(file_path)
+            evicted.append(file_path)
+            print(f"🗑️ Evicted {file_path} to make room for downloads")
+        return evicted
+
+    async def evict(self, needed):
+        """Delete the oldest evictable files until `needed` more bytes are free.
+
+        Nothing is deleted when all of them together would not be enough.
+        """
+        if needed <= 0 or not self.evict_folders:
+            return
+        async with self.evicting:
+            candidates = self.eviction_candidates()
+            if sum(size for _, _, size in candidates) < needed:
+                return
+            evicted = await asyncio.to_thread(self.remove_oldest, candidates, needed)
+            for file_path in evicted:
+                library_catalog.remove(file_path)
+
+    async def admit(self, download_path, size):
+        """Reserve room for a new download, returns "ok", "defer" or "reject"."""
+        available = await asyncio.to_thread(self.free) - self.margin
+        if available < size:
+            # Only the disk itself being short is worth deleting files for
+            await self.evict(size - available)
+            available = await asyncio.to_thread(self.free) - self.margin
+            if available < size:
+                return 'reject'
+        others = self.reserved_total - self.reservations.get(download_path, 0)
+        self.reserve(download_path, size)
+        # Fits on the disk as it is now, just not next to the queued files
+        return 'ok' if available - others >= size else 'defer'
+
+    async def fits(self, download_path):
+        """Whether a reserved download can start now, evicting files if allowed.
+
+        Only running downloads count against it, otherwise two deferred
+        files could each wait for the other forever.
+        """
+        needed = self.reservations.get(download_path)
+        if needed is None:
+            return True
+        others = self.running_total - (needed if download_path in self.running else 0)
+        room = await asyncio.to_thread(self.free) - self.margin - others
+        if room < needed:
+            await self.evict(needed - room)
+            room = await asyncio.to_thread(self.free) - self.margin - others
+        if room < needed or download_path not in self.reservations:
+            return False
+        self.start(download_path)
+        return True
+
+    def usage(self):
+        """Text for /espacio, folder sizes come from the catalog without touching the disk."""
+        total, free = self.statvfs()
+        lines = ["💾 **Espacio en disco**\n"]
+        for folder in library_catalog.folders:
+            # Copied at once, the event loop may change the catalog meanwhile
+            files = list(library_catalog.files.get(folder, {}).values())
+            folder_size = sum(size for size, _ in files)
+            evictable = " 🗑️" if folder in self.evict_folders else ""
+            lines.append(f"📁 {folder}: {format_size(folder_size)} ({len(files)} archivos){evictable}")
+        lines += [
+            "",
+            f"📦 Libre: {format_size(free)} de {format_size(total)}",
+            f"⏳ Reservado para descargas: {format_size(self.reserved_total)} ({len(self.reservations)} archivos)",
+            f"🛟 Margen: {format_size(self.margin)}",
+        ]
+        if self.evict_folders:
+            lines.append("\n🗑️ Los archivos más antiguos de estas carpetas se borran si falta espacio.")
+        return "\n".join(lines)
+
+
+disk_space = None  # Created by open_storage()
+
+HASH_READ_SIZE = 1024 * 1024
+
+def write_hashed(fd, data, offset, digest=None):
+    """pwrite `data` at `offset`, feeding it to `digest` first.
+
+    Runs in the writer threads; hashlib releases the GIL on large buffers,
+    so hashing adds no work to the event loop.
+    """
+    if digest is not None:
+        digest.update(data)
+    return os.pwrite(fd, data, offset)
+
+def hash_range(fd, start, end, drop_cache=False):
+    """SHA-256 of bytes [start, end) of an open file."""
+    digest = hashlib.sha256()
+    offset = start
+    while offset < end:
+        data = os.pread(fd, min(HASH_READ_SIZE, end - offset), offset)
+        if not data:
+            break  # Shorter than expected, the digest won't match anyway
+        digest.update(data)
+        offset += len(data)
+    if drop_cache and hasattr(os, 'posix_fadvise'):
+        # Don't push recently downloaded files out of the page cache
+        os.posix_fadvise(fd, start, end - start, os.POSIX_FADV_DONTNEED)
+    return digest.hexdigest()
+
+def combine_part_hashes(part_hashes):
+    """Checksum of a file from the SHA-256 of each of its parts, in order."""
+    digest = hashlib.sha256()
+    for part_hash in part_hashes:
+        digest.update(bytes.fromhex(part_hash))
+    return digest.hexdigest()
+
+
+class ChecksumManifest:
+    """Persistent checksums of the files downloaded by the bot.
+
+    Segmented downloads write their ranges out of order, so each part of
+    `part_size` bytes is hashed with SHA-256 as it is written and the file
+    checksum is the SHA-256 of the part digests in order. It is stored with
+    the size and the Telegram document id, and `/verificar` recomputes it
+    from disk. No file is ever read back just to hash it.
+    """
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS checksums ('
+            ' path TEXT PRIMARY KEY,'
+            ' document_id INTEGER,'
+            ' size INTEGER NOT NULL,'
+            ' algorithm TEXT NOT NULL,'
+            ' part_size INTEGER NOT NULL,'
+            ' digest TEXT NOT NULL,'
+            ' added_at REAL NOT NULL,'
+            ' verified_at REAL,'
+            ' status TEXT)'
+        )
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def add(self, file_path, size, document_id, digest, part_size):
+        self.execute(
+            'INSERT OR REPLACE INTO checksums'
+            ' (path, document_id, size, algorithm, part_size, digest, added_at)'
+            " VALUES (?, ?, ?, 'sha256', ?, ?, ?)",
+            (file_path, document_id, size, part_size, digest, time.time())
+        )
+
+    def copy(self, source, target, document_id=None):
+        """Give `target` the checksum of `source`, e.g. for a hardlinked duplicate."""
+        self.execute(
+            'INSERT OR REPLACE INTO checksums'
+            ' (path, document_id, size, algorithm, part_size, digest, added_at)'
+            ' SELECT ?, ?, size, algorithm, part_size, digest, ? FROM checksums WHERE path = ?',
+            (target, document_id, time.time(), source)
+        )
+
+    def remove(self, file_path):
+        self.execute('DELETE FROM checksums WHERE path = ?', (file_path,))
+
+    def mark(self, file_path, status):
+        self.execute(
+            'UPDATE checksums SET verified_at = ?, status = ? WHERE path = ?',
+            (time.time(), status, file_path)
+        )
+
+    def entries(self):
+        """(path, size, part_size, digest) of every file, least recently verified first."""
+        return self.execute(
+            'SELECT path, size, part_size, digest FROM checksums'
+            ' ORDER BY verified_at IS NOT NULL, verified_at, added_at'
+        )
+
+
+checksum_manifest = None  # Opened by open_storage()
+
+async def find_duplicate(message):
+    """Return the path of a library file with the same content as the message document."""
+    document = message.media.document
+    file_path = library_index.find_document(document)
+    if file_path:
+        return file_path
+
+    # Files added outside the bot are hashed lazily, only when the size matches
+    await asyncio.to_thread(library_index.index_catalog_size, library_catalog, document.size)
+    if not library_index.has_size(document.size):
+        return None
+
+    digest = await partial_hash_remote(message)
+    return library_index.find_content(document.size, digest)
+
+def link_duplicate(existing_path, download_path, document):
+    """Expose an existing file under a new name without copying it."""
+    os.link(existing_path, download_path)
+    library_index.add(download_path, document, digest=None)
+    checksum_manifest.copy(existing_path, download_path, document.id)
+    library_catalog.add(download_path)
+
+def free_download_path(download_path):
+    """Return `download_path`, or a numbered variant when the name is taken.
+
+    A name is also taken while a queued or running download reserves it.
+    """
+    base, extension = os.path.splitext(download_path)
+    candidate = download_path
+    counter = 2
+    while (os.path.exists(candidate) or os.path.exists(f'{candidate}.part')
+           or candidate in disk_space.reservations):
+        candidate = f'{base} ({counter}){extension}'
+        counter += 1
+    return candidate
+
+# Map user-friendly type to folder name
+TYPE_TO_FOLDER = {
+    'video': 'Video',
+    'music': 'Music',
+    'document': 'Documents',
+    'videos': 'Video',
+    'musics': 'Music',
+    'documentos': 'Documents',
+    'documento': 'Documents',
+    'música': 'Music',
+    'músicas': 'Music',
+    'cancion': 'Music',
+    'canciones': 'Music',
+    'vídeo': 'Video',
+    'vídeos': 'Video'
+}
+
+LIST_PAGE_SIZE = 10
+
+def render_file_page(folder_name, page):
+    """Build the text and navigation buttons of one /listar page."""
+    files = library_catalog.sorted_files(folder_name)
+    pages = max(1, -(-len(files) // LIST_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+
+    file_list = [
+        f"• `{name}` ({format_size(size)})"
+        for name, size, _ in files[page * LIST_PAGE_SIZE:(page + 1) * LIST_PAGE_SIZE]
+    ]
+    text = (
+        f"📂 **Archivos en {folder_name}**\n\n" +
+        "\n".join(file_list) +
+        f"\n\n📋 Página {page + 1}/{pages} • Total: {len(files)} archivos"
+    )
+
+    navigation = []
+    if page > 0:
+        navigation.append(Button.inline("⬅️ Anterior", data=f"ls:{folder_name}:{page - 1}".encode()))
+    if page < pages - 1:
+        navigation.append(Button.inline("Siguiente ➡️", data=f"ls:{folder_name}:{page + 1}".encode()))
+
+    return text, [navigation] if navigation else None
+
+SEARCH_FOLDER_ICONS = {'Video': '🎬', 'Music': '🎵', 'Documents': '📄'}
+# Recent /buscar queries, the page buttons only carry their number
+search_queries = OrderedDict()
+search_query_ids = itertools.count(1)
+
+def render_search_page(query_id, page):
+    """Build the text and navigation buttons of one /buscar page."""
+    query = search_queries.get(query_id)
+    if query is None:
+        return "⌛ La búsqueda expiró, vuelve a usar /buscar.", None
+
+    total, rows = search_index.search(query, LIST_PAGE_SIZE, page * LIST_PAGE_SIZE)
+    if not total:
+        return f"🔎 No se encontraron archivos para `{query}`", None
+    pages = -(-total // LIST_PAGE_SIZE)
+
+    results = [
+        f"{SEARCH_FOLDER_ICONS.get(folder, '•')} `{os.path.basename(path)}` ({format_size(size)})"
+        for path, folder, size in rows
+    ]
+    text = (
+        f"🔎 **Resultados para** `{query}`\n\n" +
+        "\n".join(results) +
+        f"\n\n📋 Página {page + 1}/{pages} • Total: {total} archivos"
+    )
+
+    navigation = []
+    if page > 0:
+        navigation.append(Button.inline("⬅️ Anterior", data=f"bs:{query_id}:{page - 1}".encode()))
+    if page < pages - 1:
+        navigation.append(Button.inline("Siguiente ➡️", data=f"bs:{query_id}:{page + 1}".encode()))
+
+    return text, [navigation] if navigation else None
+
+async def search_files(event, query):
+    """Search the library by name, title, episode or tags."""
+    if not query:
+        await event.reply(
+            "🔎 **Buscar en la biblioteca**\n\n"
+            "Usa `/buscar <texto>`, por ejemplo:\n"
+            "`/buscar breaking bad s02`\n"
+            "`/buscar queen`"
+        )
+        return
+
+    query_id = next(search_query_ids)
+    search_queries[query_id] = query
+    if len(search_queries) > 256:
+        search_queries.popitem(last=False)
+
+    text, buttons = await asyncio.to_thread(render_search_page, query_id, 0)
+    await event.reply(text, buttons=buttons)
+
+async def search_files_page(event):
+    """Handle the next/prev buttons of a /buscar message."""
+    if event.sender_id not in ALLOWED_USER_IDS:
+        await event.answer("No tienes permisos para usar este bot.")
+        return
+
+    _, query_id, page = event.data.decode().split(':')
+    text, buttons = await asyncio.to_thread(render_search_page, int(query_id), int(page))
+    try:
+        await event.edit(text, buttons=buttons)
+    except Exception as e:
+        if "message not modified" not in str(e).lower():
+            print(f"Error changing search page: {str(e)}")
+    await event.answer()
+
+async def list_files_by_type(event, file_type):
+    """List files in the specified folder by type."""
+    try:
+        folder_name = TYPE_TO_FOLDER.get(file_type.lower())
+        if not folder_name:
+            await event.reply(
+                "❌ Tipo de archivo no válido.\n\n"
+                "📋 Usa uno de estos comandos:\n"
+                "/listar video - Muestra archivos de video\n"
+                "/listar music - Muestra archivos de música\n"
+                "/listar document - Muestra documentos"
+            )
+            return
+
+        if not library_catalog.has_folder(folder_name):
+            await event.reply(f"❌ No se encontró la carpeta para {folder_name}")
+            return
+
+        if not library_catalog.sorted_files(folder_name):
+            await event.reply(f"📂 La carpeta de {folder_name} está vacía")
+            return
+
+        text, buttons = render_file_page(folder_name, 0)
+        await event.reply(text, buttons=buttons)
+
+    except Exception as e:
+        await event.reply(f"❌ Error al listar archivos: {str(e)}")
+        print(f"Error listing files: {str(e)}")
+
+async def list_files_page(event):
+    """Handle the next/prev buttons of a /listar message."""
+    if event.sender_id not in ALLOWED_USER_IDS:
+        await event.answer("No tienes permisos para usar este bot.")
+        return
+
+    _, folder_name, page = event.data.decode().split(':')
+    text, buttons = render_file_page(folder_name, int(page))
+    try:
+        await event.edit(text, buttons=buttons)
+    except Exception as e:
+        if "message not modified" not in str(e).lower():
+            print(f"Error changing list page: {str(e)}")
+    await event.answer()
+
+# Telegram serves files in requests of at most 512KB, parts must be a multiple of it
+DOWNLOAD_REQUEST_SIZE = 512 * 1024
+DOWNLOAD_PART_SIZE = 16 * DOWNLOAD_REQUEST_SIZE
+
+def split_parts(total, part_size=DOWNLOAD_PART_SIZE):
+    """Split a file of `total` bytes into (start, end) byte ranges."""
+    return [(start, min(start + part_size, total))
+            for start in range(0, total, part_size)]
+
+class PartWriter:
+    """Writer stage of a `.part` file.
+
+    The file is preallocated to its final size with fallocate, so large
+    downloads don't fragment. Data is written in large buffers at aligned
+    offsets from a dedicated thread pool, keeping disk I/O off the event
+    loop. FSYNC_POLICY decides when data is flushed to disk: `part` after
+    every finished range (before it is recorded as done), `close` once
+    before the rename (default) or `none`.
+    """
+
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=WRITER_THREADS, thread_name_prefix='writer')
+
+    def __init__(self, path, size, fsync_policy=FSYNC_POLICY):
+        self.path = path
+        self.size = size
+        self.fsync_policy = fsync_policy
+        self.fd = None
+
+    def allocate(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.posix_fallocate(self.fd, 0, max(self.size, 1))
+        except (AttributeError, OSError):
+            # Not supported by the platform or filesystem, just set the size
+            os.ftruncate(self.fd, self.size)
+
+    async def open(self):
+        """Create and preallocate the file, which can take a while for big files."""
+        await self.run(self.allocate)
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def write(self, offset, data, digest=None):
+        written = await self.run(write_hashed, self.fd, data, offset, digest)
+        if written != len(data):
+            raise IOError(f"Short write at {offset}: {written}/{len(data)} bytes")
+
+    async def part_done(self):
+        if self.fsync_policy == 'part':
+            await self.run(os.fsync, self.fd)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    async def publish(self, final_path):
+        """Atomically rename the finished file.
+
+        The file was preallocated to its final size, so its size says nothing
+        about completion; the caller checks that every range was written.
+        """
+        if self.fsync_policy != 'none':
+            await self.run(os.fsync, self.fd)
+        self.close()
+
+        os.replace(self.path, final_path)
+        if self.fsync_policy != 'none':
+            await self.run(fsync_directory, os.path.dirname(final_path))
+
+def fsync_directory(path):
+    fd = os.open(path or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class PooledClient:
+    """A download connection and the number of ranges it is serving."""
+
+    __slots__ = ('client', 'name', 'active', 'healthy', 'reconnecting')
+
+    def __init__(self, client, name, healthy=True):
+        self.client = client
+        self.name = name
+        self.active = 0
+        self.healthy = healthy
+        self.reconnecting = None
+
+
+class ClientPool:
+    """Telegram connections shared by the download workers.
+
+    Besides the bot client, DOWNLOAD_CLIENTS - 1 extra sessions of the same
+    bot are logged in, each with its own connection and its own senders to
+    the DCs where files are stored. Every range is fetched through the
+    connection with the fewest active ranges, so a slow connection ends up
+    with less work. Extra sessions that fail are left out while they
+    reconnect in the background. A session only disconnects once the
+    ranges still running on it are done, they may belong to other downloads.
+    """
+
+    def __init__(self, size=DOWNLOAD_CLIENTS, reconnect_delay=5):
+        self.size = size
+        self.reconnect_delay = reconnect_delay
+        self.members = []  # The first one is the bot client
+
+    async def start(self, main_client):
+        """Add the bot client, then log in the extra sessions in the background."""
+        self.members.append(PooledClient(main_client, 'geoffrey'))
+        for i in range(1, self.size):
+            name = f'geoffrey_download_{i}'
+            member = PooledClient(TelegramClient(name, API_ID, API_HASH), name, healthy=False)
+            self.members.append(member)
+            self.reconnect(member)
+
+    def pick(self):
+        healthy = [member for member in self.members if member.healthy]
+        return min(healthy, key=lambda member: member.active) if healthy else None
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, fallback):
+        """Yield the least loaded client, or `fallback` when the pool is empty."""
+        member = self.pick()
+        if member is None:
+            yield fallback
+            return
+
+        member.active += 1
+        leases = download_leases.get()
+        if leases is not None:
+            leases.add(member)
+        try:
+            yield member.client
+        except (ConnectionError, asyncio.IncompleteReadError, InvalidBufferError):
+            # Only network errors, disk errors of the writer say nothing about the client
+            self.reconnect(member)
+            raise
+        finally:
+            member.active -= 1
+
+    def reconnect(self, member):
+        """Take `member` out of rotation and reconnect it in the background."""
+        # The bot client reconnects on its own and also serves the handlers
+        if member.reconnecting is not None or member is self.members[0]:
+            return
+        member.healthy = False
+        member.reconnecting = asyncio.create_task(self.restore(member))
+
+    async def restore(self, member):
+        delay = self.reconnect_delay
+        try:
+            # Already out of rotation, let the ranges running on it finish first
+            while member.active:
+                await asyncio.sleep(1)
+            while True:
+                try:
+                    if member.client.is_connected():
+                        await member.client.disconnect()
+                    await member.client.start(bot_token=BOT_TOKEN)
+                    member.healthy = True
+                    print(f"🔌 Download connection {member.name} ready")
+                    return
+                except Exception as e:
+                    print(f"Could not connect {member.name}, retrying in {delay}s: {str(e)}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 300)
+        finally:
+            member.reconnecting = None
+
+
+download_clients = ClientPool()
+
+async def download_part(message, writer, start, end, on_chunk):
+    """Fetch bytes [start, end) of the message document and write them at their offset.
+
+    Returns the SHA-256 of the part, computed while it is written.
+    """
+    document = message.media.document
+    user_id = current_user.get()
+    digest = hashlib.sha256()
+    offset = start
+    limit = -(-(end - start) // DOWNLOAD_REQUEST_SIZE)  # ceil division
+    buffer = bytearray()
+    buffer_offset = start
+
+    async with download_clients.acquire(message.client) as download_client:
+        async for chunk in download_client.iter_download(
+                document,
+                offset=start,
+                limit=limit,
+                request_size=DOWNLOAD_REQUEST_SIZE,
+                file_size=document.size):
+            chunk = chunk[:end - offset]
+            await bandwidth_shaper.throttle(user_id, len(chunk))
+            buffer += chunk
+            offset += len(chunk)
+            # Flush in large buffers, each one starting at a 512KB aligned offset
+            if len(buffer) >= WRITE_BUFFER_SIZE:
+                await writer.write(buffer_offset, buffer, digest)
+                buffer_offset = offset
+                buffer = bytearray()
+            await on_chunk(len(chunk))
+            if offset >= end:
+                break
+
+    if buffer:
+        await writer.write(buffer_offset, buffer, digest)
+
+    if offset < end:
+        raise IOError(f"Incomplete part {start}-{end}, got {offset - start} bytes")
+    return digest.hexdigest()
+
+def load_resume_state(state_path, document):
+    """Return {offset: SHA-256} of the parts already on disk for this document, if any."""
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    # A sidecar left by a different file with the same name is useless
+    if state.get('document_id') != document.id or state.get('size') != document.size:
+        return {}
+    hashes = state.get('hashes', {})
+    return {start: hashes.get(str(start)) for start in state.get('done', [])}
+
+def save_resume_state(state_path, document, done):
+    """Record completed parts and the confirmed contiguous offset."""
+    offset = 0
+    for start, end in split_parts(document.size):
+        if start not in done:
+            break
+        offset = end
+
+    state = {
+        'document_id': document.id,
+        'size': document.size,
+        'offset': offset,
+        'done': sorted(done),
+        'hashes': {str(start): digest for start, digest in done.items() if digest},
+    }
+    tmp_path = f'{state_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+async def download_segmented(message, download_path, progress_callback=None,
+                             connections=DOWNLOAD_CONNECTIONS):
+    """Download a document fetching several byte ranges at once.
+
+    Data goes to a `.part` file preallocated to the final size, with each
+    range written at its offset by a `PartWriter`. A `.part.json` sidecar
+    records the finished ranges and their SHA-256, so a retry continues
+    where the previous attempt stopped. The file is renamed to
+    `download_path` only once every range is on disk, and its checksum goes
+    to the `checksum_manifest`.
+    """
+    document = message.media.document
+    total = document.size
+    part_path = f'{download_path}.part'
+    state_path = f'{part_path}.json'
+
+    done = load_resume_state(state_path, document) if os.path.exists(part_path) else {}
+    pending = [(start, end) for start, end in split_parts(total) if start not in done]
+    received = sum(end - start for start, end in split_parts(total) if start in done)
+    if done:
+        print(f'Resuming {download_path} from {received/1024/1024:.1f}MB')
+
+    async def on_chunk(size):
+        nonlocal received
+        received += size
+        metrics.add_bytes(current_worker.get(), size)
+        if progress_callback:
+            result = progress_callback(received, total)
+            if asyncio.iscoroutine(result):
+                await result
+
+    async def fetch_part(start, end):
+        # A failed range is fetched again on its own, the others keep going
+        nonlocal received
+        for attempt in itertools.count(1):
+            fetched = 0
+
+            async def count_chunk(size):
+                nonlocal fetched
+                fetched += size
+                await on_chunk(size)
+
+            try:
+                return await download_part(message, writer, start, end, count_chunk)
+            except Exception as e:
+                received -= fetched  # Fetched again from the start of the range
+                if attempt > PART_MAX_RETRIES:
+                    raise
+                delay = e.seconds if isinstance(e, FloodWaitError) else min(2 ** (attempt - 1), 30)
+                print(f'\n🔁 Retrying bytes {start}-{end} of {download_path} in {delay}s: '
+                      f'{str(e) or type(e).__name__}')
+                await asyncio.sleep(delay)
+
+    async def fetch_parts():
+        # Each connection keeps pulling the next pending part, so a slow
+        # range never leaves the others idle
+        while pending:
+            start, end = pending.pop(0)
+            digest = await fetch_part(start, end)
+            await writer.part_done()
+            done[start] = digest
+            save_resume_state(state_path, document, done)
+
+    writer = PartWriter(part_path, total)
+    try:
+        await writer.open()
+        # Preallocated, statvfs already counts these bytes as used
+        disk_space.allocated(download_path)
+        fetchers = [asyncio.create_task(fetch_parts())
+                    for _ in range(max(1, min(connections, len(pending))))]
+        try:
+            await asyncio.gather(*fetchers)
+        except BaseException:
+            for fetcher in fetchers:
+                fetcher.cancel()
+            await asyncio.gather(*fetchers, return_exceptions=True)
+            raise
+
+        if len(done) != len(split_parts(total)):
+            raise IOError(f"Download of {download_path} finished with missing parts")
+        # Parts resumed from a sidecar without hashes are the only ones read back
+        for start, end in split_parts(total):
+            if not done[start]:
+                done[start] = await writer.run(hash_range, writer.fd, start, end)
+        await writer.publish(download_path)
+    finally:
+        writer.close()
+
+    checksum = combine_part_hashes(done[start] for start, _ in split_parts(total))
+    await asyncio.to_thread(
+        checksum_manifest.add, download_path, total, document.id, checksum, DOWNLOAD_PART_SIZE)
+
+    try:
+        os.remove(state_path)
+    except OSError:
+        pass
+
+    return download_path
+
+async def download_file(message, download_path, progress_callback=None):
+    """Download the message media, splitting large documents in parallel ranges."""
+    document = getattr(message.media, 'document', None)
+    if document is None:
+        return await message.download_media(
+            file=download_path,
+            progress_callback=progress_callback
+        )
+
+    connections = 1
+    if document.size >= SEGMENTED_MIN_MB * 1024 * 1024:
+        connections = DOWNLOAD_CONNECTIONS
+    return await download_segmented(message, download_path, progress_callback, connections)
+
+class DownloadStalled(asyncio.TimeoutError):
+    """Raised when the watchdog gives up on a download attempt."""
+
+
+class StallWatchdog:
+    """Follows the bytes of one download attempt and stops it when it stalls.
+
+    The progress callback feeds `observe`, and `run` checks every few
+    seconds for no bytes in `stall_timeout` seconds, for a speed under
+    `min_speed` over a whole `window`, or for running past the deadline.
+    The deadline is DEADLINE_SLACK times what the file would take at the
+    best speed seen so far, so big files on slow links are not cut short.
+    The speed checks are skipped while a bandwidth limit is set, since the
+    limit, not the connection, is what slows the download then.
+    """
+
+    def __init__(self, size, stall_timeout=STALL_TIMEOUT, min_speed=STALL_MIN_SPEED,
+                 window=STALL_WINDOW, slack=DEADLINE_SLACK, hard_limit=DOWNLOAD_TIMEOUT,
+                 check_interval=5.0):
+        self.size = size
+        self.stall_timeout = stall_timeout
+        self.min_speed = min_speed
+        self.window = window
+        self.slack = slack
+        self.hard_limit = hard_limit
+        self.check_interval = check_interval
+        self.started_at = self.last_progress_at = self.window_started_at = time.monotonic()
+        self.first_received = None  # Bytes already on disk when the attempt started
+        self.received = self.window_received = 0
+        self.peak_speed = 0.0
+
+    def wrap(self, callback):
+        def update(received_bytes, total):
+            self.observe(received_bytes)
+            if callback:
+                return callback(received_bytes, total)
+        return update
+
+    def observe(self, received_bytes):
+        if self.first_received is None:
+            self.first_received = self.window_received = received_bytes
+        if received_bytes > self.received:
+            self.received = received_bytes
+            self.last_progress_at = time.monotonic()
+
+    def check(self):
+        """Return why the attempt should be stopped, or None."""
+        now = time.monotonic()
+        elapsed = now - self.started_at
+        if self.hard_limit and elapsed > self.hard_limit:
+            return f"superó el límite de {self.hard_limit}s"
+        if now - self.last_progress_at > self.stall_timeout:
+            return f"sin datos durante {int(now - self.last_progress_at)}s"
+
+        if bandwidth_shaper.bucket.rate or bandwidth_shaper.user_rate:
+            return None
+        if now - self.window_started_at >= self.window:
+            speed = (self.received - self.window_received) / (now - self.window_started_at)
+            self.peak_speed = max(self.peak_speed, speed)
+            self.window_started_at, self.window_received = now, self.received
+            if self.min_speed and speed < self.min_speed:
+                return f"velocidad de {speed / 1024:.0f}KB/s durante {int(self.window)}s"
+        if self.peak_speed and self.first_received is not None:
+            expected = (self.size - self.first_received) / self.peak_speed
+            if elapsed > self.window + expected * self.slack:
+                return f"lleva {int(elapsed)}s y a su mejor velocidad bastaban {int(expected)}s"
+        return None
+
+    async def run(self, download):
+        """Await the `download` task, cancelling it if it stalls."""
+        try:
+            while True:
+                done, _ = await asyncio.wait({download}, timeout=self.check_interval)
+                if done:
+                    return download.result()
+                reason = self.check()
+                if reason:
+                    raise DownloadStalled(f"descarga atascada: {reason}")
+        finally:
+            if not download.done():
+                download.cancel()
+                await asyncio.gather(download, return_exceptions=True)
+
+
+async def download_with_retries(task):
+    """Download a task, retrying with backoff from the last confirmed offset.
+
+    Each attempt runs under a StallWatchdog. A stalled attempt is restarted
+    on other pool connections, while the ones it was using reconnect.
+    `retry_count` goes back to 0 after an attempt that saved new parts, so
+    only failures in a row without progress give up on a long download.
+    """
+    document = getattr(task.message.media, 'document', None)
+    state_path = f'{task.download_path}.part.json'
+    while True:
+        saved = len(load_resume_state(state_path, document)) if document else 0
+        watchdog = StallWatchdog(task.message.file.size)
+        leases = set()
+        download_leases.set(leases)
+        download = asyncio.ensure_future(download_file(
+            task.message,
+            task.download_path,
+            progress_callback=watchdog.wrap(task.progress_callback)
+        ))
+        try:
+            return await watchdog.run(download)
+        except Exception as e:
+            if isinstance(e, DownloadStalled):
+                metrics.stalls += 1
+                for member in leases:
+                    download_clients.reconnect(member)
+            if document and len(load_resume_state(state_path, document)) > saved:
+                task.retry_count = 0
+            if task.retry_count >= DOWNLOAD_MAX_RETRIES:
+                raise
+
+            task.retry_count += 1
+            delay = min(DOWNLOAD_RETRY_DELAY * 2 ** (task.retry_count - 1), 300)
+            print(f'\n🔁 Retry {task.retry_count}/{DOWNLOAD_MAX_RETRIES} '
+                  f'for {task.filename} in {delay}s: {str(e) or type(e).__name__}')
+            if task.progress:
+                task.progress.note = (
+                    f"🔁 Reintentando ({task.retry_count}/{DOWNLOAD_MAX_RETRIES}), "
+                    f"continuará desde donde se quedó en {delay}s."
+                )
+            await asyncio.sleep(delay)
+            if task.progress:
+                task.progress.note = ''
+
+def time_first_byte(callback, started_at):
+    """Wrap a progress callback to record the time to the first byte."""
+    first = True
+
+    def update(received_bytes, total):
+        nonlocal first
+        if first:
+            first = False
+            metrics.time_to_first_byte.observe(time.monotonic() - started_at)
+        return callback(received_bytes, total)
+    return update
+
+class PostProcessor:
+    """Runs ffmpeg on finished downloads, outside of the download workers.
+
+    Jobs are ffmpeg subprocesses limited by a semaphore sized to the CPU
+    count, so transcoding never takes a download slot and the host is not
+    oversubscribed. Each action writes to a `.part` file that is renamed
+    once ffmpeg succeeds. New library files are added to the catalog and
+    the indexes, thumbnails go to THUMBNAIL_PATH instead.
+    """
+
+    def __init__(self, actions=POSTPROCESS_ACTIONS, workers=POSTPROCESS_WORKERS,
+                 timeout=POSTPROCESS_TIMEOUT, keep_original=POSTPROCESS_KEEP_ORIGINAL):
+        self.actions = actions
+        self.timeout = timeout
+        self.keep_original = keep_original
+        self.slots = asyncio.Semaphore(max(workers, 1))
+        self.jobs = set()  # Keeps running jobs referenced until they finish
+
+    def actions_for(self, file_path):
+        file_type = os.path.basename(os.path.dirname(file_path))
+        actions = self.actions.get(file_type, [])
+        if 'remux' in actions and not file_path.lower().endswith('.mkv'):
+            actions = [action for action in actions if action != 'remux']
+        return actions
+
+    def submit(self, file_path, reply_to):
+        """Schedule the configured actions for `file_path`, returns at once."""
+        actions = self.actions_for(file_path)
+        if not actions:
+            return None
+        job = asyncio.create_task(self.process(file_path, actions, reply_to))
+        self.jobs.add(job)
+        job.add_done_callback(self.jobs.discard)
+        return job
+
+    def command(self, action, source):
+        """Target path and ffmpeg arguments of one action."""
+        base = os.path.splitext(source)[0]
+        if action == 'remux':
+            target = free_download_path(base + '.mp4')
+            args = ['-map', '0', '-c', 'copy', '-f', 'mp4', '-movflags', '+faststart']
+        elif action == 'audio':
+            name = os.path.basename(base) + '.mp3'
+            target = free_download_path(os.path.join(DOWNLOAD_PATH, 'Music', name))
+            args = ['-vn', '-c:a', 'libmp3lame', '-q:a', '2', '-f', 'mp3']
+        elif action == 'thumbnail':
+            file_type = os.path.basename(os.path.dirname(source))
+            name = os.path.basename(base) + '.jpg'
+            target = free_download_path(os.path.join(THUMBNAIL_PATH, file_type, name))
+            args = ['-ss', '10', '-frames:v', '1', '-vf', 'scale=640:-2', '-f', 'image2']
+        else:
+            raise ValueError(f"acción desconocida: {action}")
+        return target, args
+
+    async def run_ffmpeg(self, source, target, args):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        part_path = f'{target}.part'
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-y',
+            '-i', source, *args, part_path,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), timeout=self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            process.kill()
+            await process.wait()
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+
+        if process.returncode != 0:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            error = stderr.decode(errors='replace').strip().splitlines()
+            raise RuntimeError(error[-1] if error else f"ffmpeg terminó con código {process.returncode}")
+        os.replace(part_path, target)
+
+    async def replace_path(self, reply_to, source, target):
+        """Point the completion reply to the remuxed file instead of the deleted one."""
+        text = getattr(reply_to, 'text', None) or ''
+        if source not in text:
+            return
+        try:
+            await reply_to.edit(text.replace(source, target))
+        except Exception as e:
+            print(f"Could not update completion message: {str(e)}")
+
+    async def process(self, file_path, actions, reply_to):
+        name = os.path.basename(file_path)
+        status = None
+        try:
+            status = await reply_to.reply(f"🎬 **En espera de procesamiento:** `{name}`")
+        except Exception as e:
+            print(f"Could not send post-processing message: {str(e)}")
+
+        async with self.slots:
+            results = []
+            source = file_path
+            for action in actions:
+                if status:
+                    try:
+                        await status.edit(f"🎬 **Procesando ({action}):** `{name}`")
+                    except Exception as e:
+                        print(f"Could not update post-processing message: {str(e)}")
+                try:
+                    target, args = self.command(action, source)
+                    await self.run_ffmpeg(source, target, args)
+                except asyncio.TimeoutError:
+                    metrics.postprocess['failed'] += 1
+                    results.append(f"❌ {action}: tiempo de espera agotado")
+                    continue
+                except Exception as e:
+                    print(f"\n❌ Error post-processing {name} ({action}): {str(e)}")
+                    metrics.postprocess['failed'] += 1
+                    results.append(f"❌ {action}: {str(e)}")
+                    continue
+
+                metrics.postprocess['completed'] += 1
+                if action != 'thumbnail':
+                    library_catalog.add(target)
+                    await asyncio.to_thread(library_index.add, target)
+                    await asyncio.to_thread(search_index.add, target)
+                results.append(f"✅ {action}: `{os.path.basename(target)}`")
+
+                if action == 'remux':
+                    # Following actions read the remuxed copy
+                    if not self.keep_original:
+                        os.remove(source)
+                        library_catalog.remove(source)
+                        await asyncio.to_thread(library_index.remove, source)
+                        await asyncio.to_thread(search_index.remove, source)
+                        await asyncio.to_thread(checksum_manifest.remove, source)
+                        await self.replace_path(reply_to, source, target)
+                    source = target
+
+        print(f"\n🎬 Post-processed {name}: {', '.join(actions)}")
+        if status:
+            try:
+                await status.edit(f"🎬 **Procesamiento terminado:** `{name}`\n" + "\n".join(results))
+            except Exception as e:
+                print(f"Could not update post-processing message: {str(e)}")
+
+
+post_processor = PostProcessor()
+
+class ChecksumVerifier:
+    """Background check of the downloaded files against the checksum manifest.
+
+    Files are read by a single dedicated thread, throttled to VERIFY_RATE
+    with a TokenBucket and dropped from the page cache once hashed, so a
+    check of the whole library doesn't slow the downloads down. One check
+    runs at a time and the least recently verified files go first.
+    """
+
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix='verify')
+
+    def __init__(self, rate=VERIFY_RATE, report_interval=30):
+        self.bucket = TokenBucket(rate)
+        self.report_interval = report_interval
+        self.job = None
+        self.checked = 0
+        self.total = 0
+        self.bytes_read = 0
+
+    @property
+    def running(self):
+        return self.job is not None and not self.job.done()
+
+    def start(self, reply_to):
+        self.job = asyncio.create_task(self.run(reply_to))
+        return self.job
+
+    async def checksum(self, file_path, size, part_size):
+        """Recompute the manifest checksum of a file from disk."""
+        loop = asyncio.get_running_loop()
+        part_hashes = []
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            for start, end in split_parts(size, part_size):
+                await self.bucket.consume(end - start)
+                part_hashes.append(await loop.run_in_executor(
+                    self.executor, hash_range, fd, start, end, True))
+                self.bytes_read += end - start
+        finally:
+            os.close(fd)
+        return combine_part_hashes(part_hashes)
+
+    async def verify(self, file_path, size, part_size, digest):
+        """Return "ok", "corrupt", "missing" or "error" for one manifest entry."""
+        try:
+            if os.path.getsize(file_path) != size:
+                return 'corrupt'
+            actual = await self.checksum(file_path, size, part_size)
+        except FileNotFoundError:
+            return 'missing'
+        except OSError as e:
+            print(f"Could not verify {file_path}: {str(e)}")
+            return 'error'
+        return 'ok' if actual == digest else 'corrupt'
+
+    def describe(self):
+        return f"{self.checked}/{self.total} archivos, {format_size(self.bytes_read)} leídos"
+
+    async def run(self, reply_to):
+        entries = await asyncio.to_thread(checksum_manifest.entries)
+        if not entries:
+            await reply_to.reply("📭 No hay archivos con checksum registrado.")
+            return
+
+        self.checked, self.total, self.bytes_read = 0, len(entries), 0
+        status = None
+        try:
+            status = await reply_to.reply(
+                f"🔍 **Verificando {len(entries)} archivos** "
+                f"({format_size(sum(entry[1] for entry in entries))})"
+            )
+        except Exception as e:
+            print(f"Could not send verification message: {str(e)}")
+
+        results = {'ok': 0, 'corrupt': 0, 'missing': 0, 'error': 0}
+        failed = []
+        reported_at = time.monotonic()
+        for file_path, size, part_size, digest in entries:
+            result = await self.verify(file_path, size, part_size, digest)
+            results[result] += 1
+            metrics.verified[result] += 1
+            if result == 'missing':
+                # Deleted outside the bot, nothing left to check
+                await asyncio.to_thread(checksum_manifest.remove, file_path)
+            else:
+                await asyncio.to_thread(checksum_manifest.mark, file_path, result)
+            if result in ('corrupt', 'error'):
+                print(f"\n❌ Checksum {result}: {file_path}")
+                failed.append(f"❌ `{os.path.basename(file_path)}` ({result})")
+            self.checked += 1
+
+            if status and time.monotonic() - reported_at >= self.report_interval:
+                reported_at = time.monotonic()
+                try:
+                    await status.edit(f"🔍 **Verificando:** {self.describe()}")
+                except Exception as e:
+                    print(f"Could not update verification message: {str(e)}")
+
+        print(f"\n🔍 Verified {self.checked} files: {results}")
+        text = (
+            f"🔍 **Verificación terminada**\n"
+            f"✅ Correctos: {results['ok']}\n"
+            f"❌ Dañados: {results['corrupt']}\n"
+            f"⚠️ Ilegibles: {results['error']}\n"
+            f"🗑️ Ya no existen: {results['missing']}"
+        )
+        if failed:
+            text += "\n\n" + "\n".join(failed[:20])
+            if len(failed) > 20:
+                text += f"\n… y {len(failed) - 20} más"
+        try:
+            if status:
+                await status.edit(text)
+            else:
+                await reply_to.reply(text)
+        except Exception as e:
+            print(f"Could not send verification results: {str(e)}")
+
+
+checksum_verifier = ChecksumVerifier()
+
+def discard_partial(download_path):
+    """Delete the `.part` file and sidecar of a download that gave up."""
+    for path in (f'{download_path}.part', f'{download_path}.part.json'):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Could not delete {path}: {str(e)}")
+
+async def notify_waiters(task, text):
+    """Tell the messages that sent the same document while it was in flight how it ended."""
+    for message in task.waiters:
+        try:
+            await message.reply(text)
+        except Exception as e:
+            print(f"Could not notify a repeated request: {str(e)}")
+
+async def download_worker(queue, worker_id=0, max_size=None):
+    """Worker that processes download tasks from the queue.
+
+    Workers started with `max_size` only take files up to that many bytes.
+    """
+    # Lets the download hot path attribute bytes to this worker
+    current_worker.set(worker_id)
+    while True:
+        task = await queue.get(max_size)
+        task_id = id(task)
+        deferred = False
+        current_user.set(task.user_id)
+        metrics.queue_wait.observe(time.monotonic() - task.enqueued_at)
+
+        # Only the bookkeeping is locked, so workers download in parallel
+        async with download_lock:
+            if task_id in active_downloads:
+                queue.task_done(task)
+                continue  # Skip if task is already being processed
+
+            active_downloads[task_id] = task
+
+        try:
+            # Other files may have used the space since this one was admitted
+            if not await disk_space.fits(task.download_path):
+                print(f'\n💾 Not enough space for {task.filename}, retrying in {DISK_RETRY_DELAY}s')
+                if not task.waiting_for_space:
+                    task.waiting_for_space = True
+                    try:
+                        await task.message.reply(
+                            f"💾 **Esperando espacio libre**\n"
+                            f"📁 `{task.filename}` empezará a descargarse cuando haya "
+                            f"{format_size(task.message.file.size)} disponibles."
+                        )
+                    except Exception as e:
+                        print(f"Could not send disk space message: {str(e)}")
+
+                def requeue(task=task):
+                    # The wait for space is not time spent in the queue
+                    task.enqueued_at = time.monotonic()
+                    asyncio.ensure_future(queue.put(task))
+
+                asyncio.get_running_loop().call_later(DISK_RETRY_DELAY, requeue)
+                deferred = True
+                continue
+
+            # Create progress message
+            queue_size = queue.qsize()
+            downloading_txt = (
+                f"⬇️ **En cola: {queue_size}**\n"
+                f"**Descargando:** `{task.filename}`\n"
+                f"💾 Tamaño: {task.message.file.size/1024/1024:.1f}MB"
+            )
+
+            download_journal.set_state(task.job_id, 'active')
+
+            try:
+                if task.batch:
+                    # Albums share one status message with aggregate progress
+                    task.progress = task.batch.progress
+                    task.progress_callback = task.batch.progress_callback()
+                else:
+                    task.msg = await task.message.reply(downloading_txt)
+
+                    # The reporter edits the message, the callback only stores bytes
+                    task.progress = progress_reporter.track(
+                        task.msg, downloading_txt, task.message.file.size)
+                    task.progress_callback = task.progress.update
+
+                started_at = time.monotonic()
+                task.progress_callback = time_first_byte(task.progress_callback, started_at)
+
+                # Each attempt has a timeout, retries resume from the .part file
+                await download_with_retries(task)
+                metrics.download_time.observe(time.monotonic() - started_at)
+                metrics.downloads['completed'] += 1
+
+                print(f'\n✅ Downloaded to {task.download_path}')
+                library_catalog.add(task.download_path)
+                await asyncio.to_thread(
+                    library_index.add, task.download_path, task.message.media.document)
+                await asyncio.to_thread(search_index.add, task.download_path)
+                await notify_waiters(
+                    task,
+                    "✅ **Descarga completada**\n"
+                    f"📁 `{task.filename}`\n"
+                    f"📂 Guardado en: `{task.download_path}`"
+                )
+
+                if task.batch:
+                    await task.batch.task_finished(task)
+                    # The album progress message is deleted once the album is done
+                    post_processor.submit(task.download_path, task.message)
+                    download_journal.remove(task.job_id)
+                    continue
+
+                # Update message when download is complete
+                file_size = os.path.getsize(task.download_path)
+
+                completion_msg = await task.msg.reply(
+                    "✅ **Descarga completada**\n"
+                    f"📁 `{task.filename}`\n"
+                    f"💾 Tamaño: {file_size/1024/1024:.1f}MB\n"
+                    f"📂 Guardado en: `{task.download_path}`"
+                )
+                # Runs in its own pool, the worker moves on to the next download
+                post_processor.submit(task.download_path, completion_msg)
+
+                # Delete the progress and queue messages after a short delay
+                await asyncio.sleep(2)  # Give user time to see the completion message
+                try:
+                    await task.msg.delete()
+                except Exception as e:
+                    print(f"Could not delete progress message: {str(e)}")
+
+                try:
+                    print(task.queue_msg)
+                    if task.queue_msg:
+                        await task.queue_msg.delete()
+                except Exception as e:
+                    print(f"Could not delete queue message: {str(e)}")
+
+            except asyncio.TimeoutError:
+                error_msg = (
+                    f"⏱️ **Tiempo de espera agotado**\n"
+                    f"`{task.filename}`\n"
+                    "La descarga tomó demasiado tiempo. Inténtalo de nuevo más tarde."
+                )
+                print(f'\n❌ Download timed out: {task.filename}')
+                metrics.downloads['timeout'] += 1
+                discard_partial(task.download_path)
+                await notify_waiters(task, error_msg)
+                if task.batch:
+                    await task.batch.task_finished(task, error="tiempo de espera agotado")
+                elif task.msg:
+                    await task.msg.edit(error_msg)
+
+            except Exception as e:
+                error_msg = (
+                    f"❌ **Error al descargar**\n"
+                    f"`{task.filename}`\n"
+                    f"Error: {str(e)}"
+                )
+                print(f'\n❌ Error downloading {task.filename}: {str(e)}')
+                metrics.downloads['failed'] += 1
+                discard_partial(task.download_path)
+                await notify_waiters(task, error_msg)
+                if task.batch:
+                    await task.batch.task_finished(task, error=str(e))
+                elif task.msg:
+                    await task.msg.edit(error_msg)
+
+            # Finished one way or another, a cancelled worker keeps the task journaled
+            download_journal.remove(task.job_id)
+
+        except Exception as e:
+            print(f"\n❌ Error in download worker: {str(e)}")
+            download_journal.remove(task.job_id)
+
+        finally:
+            if task.progress and not task.batch:
+                progress_reporter.untrack(task.progress)
+            if not deferred:
+                disk_space.release(task.download_path)
+                document = getattr(task.message.media, 'document', None)
+                if document is not None and downloads_by_document.get(document.id) is task:
+                    del downloads_by_document[document.id]
+            async with download_lock:
+                active_downloads.pop(task_id, None)
+            queue.task_done(task)
+            # Small delay to prevent rate limiting
+            await asyncio.sleep(1)
+
+def guess_filename(filename):
+    """Guess file information using guessit."""
+    info = lazy_import('guessit').guessit(filename)
+
+    extension = info.get('container') if info.get('container') is not None else filename.split(".")[-1]
+
+    episode = f"E{info.get('episode')}" if info.get('episode') is not None else ""
+
+    season = ''
+
+    if info.get('episode') is not None:
+        season = f"S{info.get('season')}" if info.get('season') is not None else 'S0'
+
+    return f"{info.get('title')} - {season}{episode}.{extension}"
+
+def guess_filename_batch(filenames):
+    """Guess a list of names in one go, this is what runs inside the pool."""
+    return [guess_filename(filename) for filename in filenames]
+
+def prewarm_metadata():
+    """Load guessit and mutagen and build guessit's rules ahead of the first file."""
+    lazy_import('mutagen.mp3')
+    lazy_import('mutagen.easyid3')
+    lazy_import('guessit').guessit('Prewarm.Show.S01E01.1080p.WEB-DL.mkv')
+
+def normalize_metadata_key(filename):
+    return " ".join(unicodedata.normalize('NFC', filename).split())
+
+
+class MetadataService:
+    """Runs guessit off the event loop.
+
+    Parsing happens in a thread pool, or a process pool with
+    METADATA_EXECUTOR=process, behind an LRU/TTL cache of guessit results.
+    Names requested within `batch_window` seconds of each other, such as the
+    files of an album, are parsed together in a single pool call.
+    """
+
+    def __init__(self, workers=METADATA_WORKERS, kind=METADATA_EXECUTOR,
+                 cache_size=METADATA_CACHE_SIZE, ttl=METADATA_CACHE_TTL,
+                 batch_window=0.05):
+        self.workers = workers
+        if kind == 'process':
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='metadata')
+        self.cache = OrderedDict()  # key -> (expires_at, guessed name)
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.batch_window = batch_window
+        self.pending = {}  # key -> future waiting for the next batch
+        self.flush_handle = None
+
+    def cache_get(self, key):
+        item = self.cache.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return value
+
+    def cache_set(self, key, value):
+        self.cache[key] = (time.monotonic() + self.ttl, value)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def guess_filenames(self, filenames):
+        """Guessed names for `filenames`, parsing every cache miss in one pool call."""
+        keys = [normalize_metadata_key(filename) for filename in filenames]
+        results = {key: self.cache_get(key) for key in keys}
+        misses = [key for key, value in results.items() if value is None]
+
+        if misses:
+            loop = asyncio.get_running_loop()
+            guessed = await loop.run_in_executor(self.executor, guess_filename_batch, misses)
+            for key, value in zip(misses, guessed):
+                self.cache_set(key, value)
+                results[key] = value
+
+        return [results[key] for key in keys]
+
+    async def guess_filename(self, filename):
+        """Guessed name for a single file, coalesced with concurrent requests."""
+        key = normalize_metadata_key(filename)
+        cached = self.cache_get(key)
+        if cached is not None:
+            return cached
+
+        future = self.pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self.pending[key] = loop.create_future()
+            if self.flush_handle is None:
+                self.flush_handle = loop.call_later(
+                    self.batch_window, lambda: asyncio.ensure_future(self.flush()))
+        return await future
+
+    async def flush(self):
+        pending, self.pending, self.flush_handle = self.pending, {}, None
+        try:
+            guessed = await self.guess_filenames(list(pending))
+        except Exception as e:
+            for future in pending.values():
+                future.set_exception(e)
+            return
+        for future, value in zip(pending.values(), guessed):
+            future.set_result(value)
+
+    async def prewarm(self):
+        """Run prewarm_metadata on every worker of the pool."""
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.gather(*(loop.run_in_executor(self.executor, prewarm_metadata)
+                                   for _ in range(self.workers)))
+        except Exception as e:
+            print(f"Could not prewarm metadata parsers: {str(e)}")
+
+
+metadata_service = MetadataService()
+
+def clean_string(s):
+    """Clean string for filename usage."""
+    return s.strip().replace('/', '_').replace('\\', '_').replace('\n', '_').replace('\r', '_').replace(':', '_')
+
+def attach_to_download(message, document):
+    """Answer `message` when the queued or running download of `document` ends."""
+    task = downloads_by_document[document.id]
+    task.waiters.append(message)
+    return (
+        f"⏳ **Este archivo ya está en cola**\n"
+        f"📁 `{task.filename}`\n"
+        "Te avisaré cuando termine de descargarse."
+    )
+
+async def prepare_download(event, message_text):
+    """Work out name and destination of a document.
+
+    Returns `(task, None)` when the file has to be downloaded, or
+    `(None, reply_text)` when it was rejected or is already in the library.
+    """
+    attr_filename = ''
+    filename = ''
+    
+    for attr in event.message.media.document.attributes:
+        if isinstance(attr, DocumentAttributeFilename):
+            attr_filename = attr.file_name
+            print(f'Original filename: {attr_filename}')
+            break
+
+    # Check file type
+    file_type = get_file_type(event.message.media.document.mime_type)
+    
+    if not file_type:
+        return None, f"❌ Tipo de archivo no soportado {file_type}. Solo se permiten videos, audios y documentos."
+
+    document = event.message.media.document
+    if document.id in downloads_by_document:
+        return None, attach_to_download(event.message, document)
+
+    filename = attr_filename
+
+    if file_type == "Video":
+        # Replace name whether the file is a Video
+        filename = f"{message_text} - {attr_filename}" if message_text else attr_filename
+        filename = await metadata_service.guess_filename(clean_string(filename))
+    
+    # Clean filename    
+    filename = clean_string(filename)
+
+    print("Final Filename", filename)
+
+    # Create download directory if it doesn't exist
+    download_dir = f'{DOWNLOAD_PATH}/{file_type}'
+    os.makedirs(download_dir, exist_ok=True)
+    download_path = f'{download_dir}/{filename}'
+
+    # Skip the transfer when we already have the same document or content
+    try:
+        existing_path = await find_duplicate(event.message)
+    except Exception as e:
+        print(f"Could not check duplicates: {str(e)}")
+        existing_path = None
+
+    if existing_path:
+        if existing_path == download_path or check_filename_exists(download_path):
+            return None, f"❌ El archivo {os.path.basename(existing_path)} ya existe en el servidor."
+        if download_path in disk_space.reservations:
+            download_path = free_download_path(download_path)
+            filename = os.path.basename(download_path)
+        try:
+            link_duplicate(existing_path, download_path, document)
+        except OSError as e:
+            print(f"Could not link {existing_path}: {str(e)}")
+            return None, f"❌ El archivo ya existe en el servidor como `{os.path.basename(existing_path)}`."
+        return None, (
+            f"✅ **El archivo ya estaba descargado**\n"
+            f"📁 `{filename}`\n"
+            f"🔗 Enlazado a `{os.path.basename(existing_path)}` sin volver a descargarlo."
+        )
+
+    # Same name but different content, keep both files. Queued and running
+    # downloads hold their name too, they would share the .part file otherwise
+    if check_filename_exists(download_path) or download_path in disk_space.reservations:
+        download_path = free_download_path(download_path)
+        filename = os.path.basename(download_path)
+
+    # Claimed before awaiting, so a concurrent message picks another name
+    disk_space.reserve(download_path, 0)
+
+    # Don't start what can't fit on the disk
+    size = document.size
+    try:
+        verdict = await disk_space.admit(download_path, size)
+    except BaseException:
+        disk_space.release(download_path)
+        raise
+    if verdict == 'reject':
+        disk_space.release(download_path)
+        free = await asyncio.to_thread(disk_space.free)
+        return None, (
+            f"💾 **No hay espacio suficiente**\n"
+            f"📁 `{filename}` necesita {format_size(size)} y quedan "
+            f"{format_size(max(0, free - disk_space.margin))} libres."
+        )
+
+    # Sent again while this one was being prepared
+    if document.id in downloads_by_document:
+        disk_space.release(download_path)
+        return None, attach_to_download(event.message, document)
+
+    # Create download task
+    task = DownloadTask(
+        message=event.message,
+        filename=filename,
+        download_path=download_path,
+        event=event
+    )
+    downloads_by_document[document.id] = task
+    return task, None
+
+
+class DownloadBatch:
+    """Files of an album downloaded as one job.
+
+    The children are regular `DownloadTask`s spread over the workers, but
+    they share a single status message with the aggregate progress and a
+    single completion reply.
+    """
+
+    def __init__(self, tasks, title):
+        self.tasks = tasks
+        self.msg = None
+        self.title = title
+        self.pending = len(tasks)
+        self.failed = []
+        self.progress = ProgressEntry(
+            None, self.status_text(), sum(task.message.file.size for task in tasks))
+
+    def attach(self, msg):
+        """Show the progress in `msg`, the reply announcing the album."""
+        self.msg = self.progress.msg = msg
+        progress_reporter.entries.add(self.progress)
+
+    def status_text(self):
+        done = len(self.tasks) - self.pending
+        return (
+            f"{self.title}\n"
+            f"✅ Completados: {done}/{len(self.tasks)}"
+        )
+
+    def progress_callback(self):
+        """Callback of one child, adding its bytes to the album total."""
+        entry = self.progress
+        last = 0
+
+        def update(received_bytes, total):
+            nonlocal last
+            entry.received += received_bytes - last
+            last = received_bytes
+        return update
+
+    async def task_finished(self, task, error=None):
+        self.pending -= 1
+        if error:
+            self.failed.append((task.filename, error))
+        self.progress.text = self.status_text()
+        if self.pending:
+            return
+
+        progress_reporter.untrack(self.progress)
+        saved = len(self.tasks) - len(self.failed)
+        summary = (
+            f"✅ **Álbum descargado**\n"
+            f"📁 {saved}/{len(self.tasks)} archivos guardados\n"
+            f"💾 Tamaño: {self.progress.total/1024/1024:.1f}MB"
+        )
+        if self.failed:
+            summary += "\n\n❌ **Errores:**\n" + "\n".join(
+                f"• `{filename}`: {error}" for filename, error in self.failed)
+        if self.msg is None:
+            return
+        try:
+            await self.msg.reply(summary)
+            await asyncio.sleep(2)  # Give user time to see the completion message
+            await self.msg.delete()
+        except Exception as e:
+            print(f"Could not update album message: {str(e)}")
+
+
+class AlbumCollector:
+    """Groups the messages of an album (same `grouped_id`) into one batch.
+
+    Telegram delivers each file of an album as a separate message, so they
+    are buffered until no new file arrives for `window` seconds.
+    """
+
+    def __init__(self, window=ALBUM_WINDOW):
+        self.window = window
+        self.albums = {}  # grouped_id -> [(event, message_text)]
+        self.timers = {}
+
+    def add(self, event, message_text):
+        grouped_id = event.message.grouped_id
+        self.albums.setdefault(grouped_id, []).append((event, message_text))
+
+        timer = self.timers.pop(grouped_id, None)
+        if timer:
+            timer.cancel()
+        self.timers[grouped_id] = asyncio.get_running_loop().call_later(
+            self.window, lambda: asyncio.ensure_future(self.flush(grouped_id)))
+
+    async def flush(self, grouped_id):
+        self.timers.pop(grouped_id, None)
+        items = self.albums.pop(grouped_id, [])
+        try:
+            await enqueue_album(items)
+        except Exception as e:
+            print(f"Error queueing album {grouped_id}: {str(e)}")
+
+
+album_collector = AlbumCollector()
+
+async def enqueue_album(items):
+    """Prepare every file of an album and queue them as one batch."""
+    items.sort(key=lambda item: item[0].message.id)
+    first_event = items[0][0]
+    # The caption usually comes in only one of the messages, use it for all
+    caption = next((text for _, text in items if text), "")
+
+    print(f"📥 Nuevo álbum en Geoffrey: {len(items)} archivos")
+    results = await asyncio.gather(*(prepare_download(event, caption) for event, _ in items))
+    tasks = [task for task, _ in results if task is not None]
+    skipped = [reply_text for task, reply_text in results if task is None]
+
+    skipped_text = ""
+    if skipped:
+        skipped_text = f"\n\n⏭️ {len(skipped)} archivos omitidos:\n" + "\n".join(skipped)
+
+    if not tasks:
+        await first_event.reply(f"📥 **Álbum sin archivos nuevos**{skipped_text}")
+        return
+
+    batch = DownloadBatch(tasks, f"⬇️ **Álbum:** {len(tasks)} archivos")
+    title = (
+        f"📥 **Álbum agregado a la cola**\n"
+        f"📄 {len(tasks)} archivos\n"
+        f"🔄 Archivos antes en la cola: {download_queue.qsize()}"
+    )
+    # Attached before queueing, the files could finish before the reply is sent otherwise
+    try:
+        batch.attach(await first_event.reply(title + skipped_text))
+    except Exception as e:
+        print(f"Could not send album message: {str(e)}")
+
+    for task in tasks:
+        task.batch = batch
+        await enqueue_download(task)
+
+PRIORITY_LEVELS = {'alta': 1, 'high': 1, 'normal': 0, 'baja': -1, 'low': -1}
+PRIORITY_NAMES = {1: 'alta', 0: 'normal', -1: 'baja'}
+
+async def change_priority(event, args):
+    """List the queued files of the user, or change the priority of one of them."""
+    tasks = download_queue.user_tasks(event.sender_id)
+    if not tasks:
+        await event.reply("📭 No tienes archivos en cola.")
+        return
+
+    if not args:
+        lines = [
+            f"{i}. `{task.filename}` (posición {download_queue.position(task)}, "
+            f"prioridad {PRIORITY_NAMES.get(task.priority, task.priority)})"
+            for i, task in enumerate(tasks, 1)
+        ]
+        await event.reply(
+            "📋 **Tus archivos en cola**\n\n" + "\n".join(lines) +
+            "\n\nUsa `/prioridad <número o nombre> [alta|normal|baja]`"
+        )
+        return
+
+    parts = args.rsplit(maxsplit=1)
+    priority = PRIORITY_LEVELS.get(parts[-1]) if len(parts) > 1 else None
+    query = parts[0] if priority is not None else args
+    if priority is None:
+        priority = 1
+
+    if query.isdigit() and 1 <= int(query) <= len(tasks):
+        task = tasks[int(query) - 1]
+    else:
+        matches = [task for task in tasks if query in task.filename.lower()]
+        if len(matches) != 1:
+            await event.reply(f"❌ {len(matches)} archivos coinciden con `{query}`, usa su número.")
+            return
+        task = matches[0]
+
+    if not await download_queue.set_priority(task, priority):
+        await event.reply(f"❌ `{task.filename}` ya no está en cola.")
+        return
+    await event.reply(
+        f"✅ Prioridad {PRIORITY_NAMES[priority]} para `{task.filename}`\n"
+        f"🔄 Posición en cola: {download_queue.position(task)}"
+    )
+
+async def change_bandwidth_limit(event, args):
+    """Show or change the global download limit at runtime (admins only)."""
+    if event.sender_id not in ADMIN_USER_IDS:
+        await event.reply("❌ Solo los administradores pueden cambiar el límite.")
+        return
+
+    if args:
+        if args in ('auto', 'horario'):
+            bandwidth_shaper.set_override(None)
+        else:
+            try:
+                bandwidth_shaper.set_override(float(args.replace(',', '.')) * 1024 * 1024)
+            except ValueError:
+                await event.reply("❌ Usa `/limite <MB/s>`, `/limite 0` para quitarlo o `/limite auto`.")
+                return
+
+    mode = "manual" if bandwidth_shaper.override is not None else "automático"
+    await event.reply(f"🚦 Límite de descarga: {bandwidth_shaper.describe()} ({mode})")
+
+async def verify_command(event, args):
+    """Check the downloaded files against their checksums in the background (admins only)."""
+    if event.sender_id not in ADMIN_USER_IDS:
+        await event.reply("❌ Solo los administradores pueden verificar los archivos.")
+        return
+
+    if checksum_verifier.running:
+        await event.reply(f"🔍 Verificación en curso: {checksum_verifier.describe()}")
+        return
+    checksum_verifier.start(event)
+
+async def help_command(event, args):
+    await show_help(event)
+
+async def list_command(event, args):
+    if args:
+        await list_files_by_type(event, args)
+        return
+
+    # Show help for list command
+    await event.reply(
+        "📋 **Lista de archivos disponibles**\n\n"
+        "Usa uno de estos comandos:\n"
+        "`/listar video` - Muestra archivos de video\n"
+        "`/listar music` - Muestra archivos de música\n"
+        "`/listar document` - Muestra documentos\n\n"
+        "*Sugerencia:* Usa `/l` en lugar de `/listar` para ahorrar tiempo.\n"
+        "Ejemplo: `/l video`"
+    )
+
+async def disk_usage_command(event, args):
+    text = await asyncio.to_thread(disk_space.usage)
+    await event.reply(text)
+
+# Exact command tokens -> (name used in metrics, handler taking (event, args))
+COMMANDS = {
+    '/help': ('/help', help_command),
+    '/ayuda': ('/help', help_command),
+    '/start': ('/help', help_command),
+    '/limite': ('/limite', change_bandwidth_limit),
+    '/prioridad': ('/prioridad', change_priority),
+    '/listar': ('/listar', list_command),
+    '/list': ('/listar', list_command),
+    '/l': ('/listar', list_command),
+    '/buscar': ('/buscar', search_files),
+    '/espacio': ('/espacio', disk_usage_command),
+    '/space': ('/espacio', disk_usage_command),
+    '/verificar': ('/verificar', verify_command),
+    '/verify': ('/verificar', verify_command),
+    '/search': ('/buscar', search_files),
+}
+
+
+class CommandThrottle:
+    """Per-user token buckets that drop excess messages instead of delaying them.
+
+    `check` returns "allow", "warn" for the first refused message of a burst
+    (so the user is told once) or "drop". A rate of 0 disables it.
+    """
+
+    def __init__(self, rate=COMMAND_RATE, burst=COMMAND_BURST, max_users=4096):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.buckets = {}  # user id -> [tokens, updated_at, warned]
+
+    def check(self, user_id):
+        if not self.rate:
+            return 'allow'
+        now = time.monotonic()
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            if len(self.buckets) >= self.max_users:
+                self.prune(now)
+            bucket = self.buckets[user_id] = [self.burst, now, False]
+
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return 'allow'
+        if bucket[2]:
+            return 'drop'
+        bucket[2] = True
+        return 'warn'
+
+    def prune(self, now):
+        """Forget users whose bucket has refilled, they start full anyway."""
+        self.buckets = {
+            user_id: bucket for user_id, bucket in self.buckets.items()
+            if bucket[0] + (now - bucket[1]) * self.rate < self.burst
+        }
+
+
+command_throttle = CommandThrottle()
+# Unauthorized users get the rejection once an hour, the rest is ignored
+unauthorized_throttle = CommandThrottle(rate=1 / 3600, burst=1)
+
+# Handler para mensajes nuevos
+async def handler(event):
+    if event.sender_id not in ALLOWED_USER_IDS:
+        metrics.messages['unauthorized'] += 1
+        if unauthorized_throttle.check(event.sender_id) == 'allow':
+            await event.reply("No tienes permisos para usar este bot.")
+        return
+
+    message_text = (event.message.text or "").strip().lower()
+
+    if message_text.startswith('/'):
+        parts = message_text.split(maxsplit=1)
+        # "/listar@geoffrey_bot video" is the same command as "/listar video"
+        command = COMMANDS.get(parts[0].split('@', 1)[0])
+        if command is not None:
+            name, run_command = command
+            verdict = command_throttle.check(event.sender_id)
+            if verdict != 'allow':
+                metrics.messages['throttled'] += 1
+                if verdict == 'warn':
+                    await event.reply("⏳ Demasiados comandos seguidos, espera unos segundos.")
+                return
+
+            metrics.messages['accepted'] += 1
+            started = time.monotonic()
+            try:
+                await run_command(event, parts[1].strip() if len(parts) > 1 else '')
+            finally:
+                metrics.observe_command(name, time.monotonic() - started)
+            return
+
+    print("📥 Nuevo mensaje en Geoffrey:", message_text)
+
+    if isinstance(event.message.media, MessageMediaDocument):
+        metrics.messages['accepted'] += 1
+        started = time.monotonic()
+        try:
+            await handle_document(event, message_text)
+        finally:
+            metrics.observe_command('document', time.monotonic() - started)
+
+async def handle_document(event, message_text):
+    # Albums are collected and queued as a single batch
+    if event.message.grouped_id:
+        album_collector.add(event, message_text)
+        return
+
+    task, reply_text = await prepare_download(event, message_text)
+    if task is None:
+        await event.reply(reply_text)
+        return
+
+    queue = await enqueue_download(task)
+    queue_size = queue.position(task)
+
+    # Notify user that the download is queued and store the message
+    task.queue_msg = await event.reply(
+        f"📥 **Archivo agregado a la cola**\n"
+        f"📄 `{task.filename}`\n"
+        f"🔄 Posición en cola: {queue_size}"
+    )
+
+def open_storage():
+    """Open the SQLite stores and the disk accounting.
+
+    Done at startup instead of on import, so importing the module creates
+    no files or folders.
+    """
+    global download_journal, library_index, search_index, checksum_manifest, disk_space
+    download_journal = DownloadJournal(QUEUE_DB_PATH)
+    library_index = LibraryIndex(LIBRARY_DB_PATH)
+    search_index = SearchIndex(SEARCH_DB_PATH)
+    checksum_manifest = ChecksumManifest(CHECKSUM_DB_PATH)
+    disk_space = DiskSpace(DOWNLOAD_PATH or '.')
+
+async def run_bot():
+    global client
+    if not API_ID:
+        raise SystemExit("API_ID is not set")
+    started = time.monotonic()
+    open_storage()
+    client = TelegramClient('geoffrey', API_ID, API_HASH)
+
+    # Start download workers, small files get their own pool when configured
+    workers = [asyncio.create_task(download_worker(download_queue, i))
+               for i in range(DOWNLOAD_WORKERS)]
+    workers += [asyncio.create_task(download_worker(
+                    download_queue, DOWNLOAD_WORKERS + i, max_size=SMALL_FILE_MAX_MB * 1024 * 1024))
+                for i in range(SMALL_DOWNLOAD_WORKERS)]
+
+    # Kept referenced, the event loop only holds weak references to tasks
+    background = [asyncio.create_task(progress_reporter.run())]
+    if METRICS_PORT:
+        background.append(asyncio.create_task(metrics.run()))
+
+    # Connecting, indexing the library and loading guessit don't depend on
+    # each other, so they overlap instead of adding up
+    await asyncio.gather(
+        client.start(bot_token=BOT_TOKEN),
+        asyncio.to_thread(library_catalog.build),
+        metadata_service.prewarm(),
+    )
+    background.append(asyncio.create_task(library_catalog.watch()))
+    # Parses only what changed since the last run, in the background
+    background.append(asyncio.create_task(search_index.watch(library_catalog)))
+    await download_clients.start(client)
+
+    client.add_event_handler(list_files_page, events.CallbackQuery(pattern=b'ls:'))
+    client.add_event_handler(search_files_page, events.CallbackQuery(pattern=b'bs:'))
+
+    client.add_event_handler(handler, events.NewMessage)
+
+    metrics.startup_seconds = time.monotonic() - STARTUP_STARTED
+    print(f"🚀 Ready to accept messages in {metrics.startup_seconds:.2f}s "
+          f"(imports {started - STARTUP_STARTED:.2f}s, startup {time.monotonic() - started:.2f}s)")
+
+    # Resume whatever was queued before the last restart
+    await restore_download_queue()
+
+    # Mantener el cliente corriendo
+    await client.run_until_disconnected()
+
+def main():
+    asyncio.run(run_bot())
 
-with client:
-    client.loop.run_until_complete(main())
\ No newline at end of file
+if __name__ == '__main__':
+    main()
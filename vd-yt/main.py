@@ -1,57 +1,170 @@
+"""Batch downloader of YouTube audio.
+
+Reads URLs (or bare video ids) from files or stdin, one per line, and
+downloads the audio of each video into `downloaded/`. Video ids already in
+the manifest are skipped, so an interrupted run can simply be started again.
+
+Usage:
+    python main.py videos.txt
+    cat videos.txt | python main.py --workers 8
+"""
+import os
 import re
+import sys
+import json
+import argparse
+import threading
+import fileinput
+import concurrent.futures
+from urllib.parse import urlparse, parse_qs
+
 import pytube
+from pytube import request
 
+OUTPUT_DIR = 'downloaded'
+MANIFEST_NAME = '.manifest.jsonl'
+VIDEO_ID = re.compile(r'^[A-Za-z0-9_-]{11}$')
 
-def download_video(video_url):
-    # Cree un objeto Pytube para el video
-    video = pytube.YouTube(video_url)
 
-    video_title = video.title
+def video_id(value):
+    """Return the video id of a YouTube URL or bare id, None if there is none.
+
+    Playlist and position parameters like `&list=` or `&index=` are ignored,
+    so the same video linked from different places is downloaded once.
+    """
+    value = value.strip()
+    if VIDEO_ID.match(value):
+        return value
+
+    url = urlparse(value if '://' in value else f'https://{value}')
+    host = url.netloc.lower().removeprefix('www.').removeprefix('m.')
+    candidate = None
+    if host == 'youtu.be':
+        candidate = url.path.lstrip('/').split('/')[0]
+    elif host.endswith('youtube.com'):
+        if url.path == '/watch':
+            candidate = parse_qs(url.query).get('v', [None])[0]
+        else:
+            parts = url.path.strip('/').split('/')
+            if len(parts) >= 2 and parts[0] in ('shorts', 'embed', 'live', 'v'):
+                candidate = parts[1]
+
+    return candidate if candidate and VIDEO_ID.match(candidate) else None
+
+
+def read_video_ids(lines):
+    """Unique video ids in input order, skipping blank lines and comments."""
+    ids = []
+    seen = set()
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        vid = video_id(line)
+        if vid is None:
+            print(f"⚠️ Not a YouTube video: {line}", file=sys.stderr)
+        elif vid not in seen:
+            seen.add(vid)
+            ids.append(vid)
+    return ids
+
+
+def clean_title(video_title):
     video_title = re.sub(r'yo quiero que este sea el mundo que conteste+', '', video_title)
     video_title = re.sub(r'Lyrics+', '', video_title)
     video_title = re.sub(r'Letra+', '', video_title)
-    # video_title = video_title.strip()\
-    #         .replace('\n', ' ').replace('/', '').replace('(', '').replace(')', '')
-        
     video_title = re.sub(r'[^a-zA-Z0-9._\-\s]', '', video_title)
-    video_title = video_title.strip()
-    # video_title = re.sub(r'_+', '_', video_title)
-    
+    return video_title.strip()
+
+
+class Manifest:
+    """Append-only record of downloaded video ids, one JSON object per line."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self.done.add(json.loads(line)['id'])
+                    except (ValueError, KeyError):
+                        continue  # A line cut short by a crash
+
+    def __contains__(self, vid):
+        return vid in self.done
+
+    def add(self, vid, title, file_path):
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'id': vid, 'title': title, 'file': file_path}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.done.add(vid)
+
+
+def download_video(vid, output_dir=OUTPUT_DIR):
+    """Download the audio of one video, returns (title, file path)."""
+    # Cree un objeto Pytube para el video
+    video = pytube.YouTube(f'https://www.youtube.com/watch?v={vid}')
+    video_title = clean_title(video.title) or vid
+
     # Filtre los flujos de audio
-    audio_streams = video.streams.filter(only_audio=True)
-
-    # Descargue el flujo de audio
-    audio_streams[0].download(filename=f"downloaded/{video_title}.mp3")
-
-
-video_list = [
-    "https://www.youtube.com/watch?v=9mI7nt40554&list=RD9mI7nt40554&start_radio=1",
-    "https://www.youtube.com/watch?v=As6pQlCkbns&list=RD9mI7nt40554&index=2",
-    "https://www.youtube.com/watch?v=860ymv-cWLA&list=RD9mI7nt40554&index=3",
-    "https://www.youtube.com/watch?v=63pTpAAF0HM&list=RD9mI7nt40554&index=4",
-    "https://www.youtube.com/watch?v=0fStdU-CBTI&list=RD9mI7nt40554&index=5",
-    "https://www.youtube.com/watch?v=BlhSvoMifVk&list=RD9mI7nt40554&index=7",
-    "https://www.youtube.com/watch?v=sDMxQF18yvA&list=RD9mI7nt40554&index=8",
-    "https://www.youtube.com/watch?v=J8NrkPLDi_k&list=RD9mI7nt40554&index=9",
-    "https://www.youtube.com/watch?v=GfUqp8gKFuQ&list=RD9mI7nt40554&index=10",
-    "https://www.youtube.com/watch?v=y9e-IJ1qY_Q&list=RD9mI7nt40554&index=12",
-    "https://www.youtube.com/watch?v=Ba8ZAD7Moeg&list=RD9mI7nt40554&index=13",
-    "https://www.youtube.com/watch?v=nfezTxgrcUo&list=RD9mI7nt40554&index=12",
-    "https://www.youtube.com/watch?v=joh4iX1bigA&list=RD9mI7nt40554&index=14",
-    "https://www.youtube.com/watch?v=VtX_9bAFIyA&list=RD9mI7nt40554&index=15",
-    "https://www.youtube.com/watch?v=Fj_lZC66-hw&list=RD9mI7nt40554&index=19",
-    "https://www.youtube.com/watch?v=5UpGvpqFZCA&list=RD9mI7nt40554&index=20",
-    "https://www.youtube.com/watch?v=_WVorCizHZs&list=RD9mI7nt40554&index=22",
-    "https://www.youtube.com/watch?v=IZjy-W5tqBI&list=RD9mI7nt40554&index=22",
-    "https://www.youtube.com/watch?v=Vt5pqoa_cjY&list=RD9mI7nt40554&index=24",
-    "https://www.youtube.com/watch?v=_gTsBdYntp4&list=RD9mI7nt40554&index=26",
-    "https://www.youtube.com/watch?v=5TFzTmVnu18&list=RD9mI7nt40554&index=27",
-    "https://www.youtube.com/watch?v=ON7H_L0K5MY&list=RD9mI7nt40554&index=23",
-    "https://www.youtube.com/watch?v=ZDbCCPxwqBI&list=RD9mI7nt40554&index=28",
-    "https://www.youtube.com/watch?v=ZcKKO_TAocs&list=RD9mI7nt40554&index=27",
-    "https://www.youtube.com/watch?v=b82IdqplUPI",
-    "https://www.youtube.com/watch?v=8G_-Jt9vezQ"
-]
-
-for video_url in video_list:
-    download_video(video_url)
+    audio_stream = video.streams.filter(only_audio=True).first()
+    if audio_stream is None:
+        raise RuntimeError('no audio stream')
+
+    # Chunks go straight to disk, the file only gets its name once complete
+    file_path = os.path.join(output_dir, f"{video_title}.mp3")
+    part_path = f'{file_path}.{vid}.part'
+    with open(part_path, 'wb') as f:
+        for chunk in request.stream(audio_stream.url):
+            f.write(chunk)
+    os.replace(part_path, file_path)
+    return video_title, file_path
+
+
+def download_all(ids, workers=4, output_dir=OUTPUT_DIR):
+    """Download every id not in the manifest, returns the ids that failed."""
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = Manifest(os.path.join(output_dir, MANIFEST_NAME))
+    pending = [vid for vid in ids if vid not in manifest]
+    print(f"{len(ids)} videos, {len(ids) - len(pending)} already downloaded, {len(pending)} pending")
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(download_video, vid, output_dir): vid for vid in pending}
+        for future in concurrent.futures.as_completed(futures):
+            vid = futures[future]
+            try:
+                title, file_path = future.result()
+            except Exception as e:
+                print(f"❌ {vid}: {str(e)}", file=sys.stderr)
+                failed.append(vid)
+                continue
+            manifest.add(vid, title, file_path)
+            print(f"✅ {vid}: {file_path}")
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='*',
+                        help='Files with one URL or video id per line, stdin when omitted')
+    parser.add_argument('--workers', type=int, default=4, help='Videos downloaded at once')
+    parser.add_argument('--output', default=OUTPUT_DIR, help='Directory to save the audio in')
+    args = parser.parse_args(argv)
+
+    with fileinput.input(args.files or ('-',), encoding='utf-8') as lines:
+        ids = read_video_ids(lines)
+
+    failed = download_all(ids, args.workers, args.output)
+    if failed:
+        print(f"{len(failed)} downloads failed, run again to retry them", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())